@@ -1,88 +1,464 @@
 import datetime
-import glob
+import gzip
+import hashlib
+import io
 import json
 import os.path
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import closing, contextmanager
 from pathlib import Path
+from typing import IO, AsyncIterator, Iterator, Optional
 
+from sqlalchemy import Table, func, select
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-from app.db.base import Base, SQLALCHEMY_DATABASE_URL, SessionLocal
+from app.db.base import (
+    Base,
+    SQLALCHEMY_DATABASE_URL,
+    SessionLocal,
+    _is_sqlite_file,
+    engine,
+)
+from app.db.backupcatalog import (
+    COMPRESSIONS,
+    FORMATS,
+    BackupCatalog,
+    BackupEntry,
+    describe,
+    file_name,
+    parse_file_name,
+)
+from app.db.cache import taxonomy_cache
 from app.db.models import AdminUserOrm
+from app.logger import create_logger
+
+try:
+    import zstandard
+except ImportError:  # optional, backups are compressed with gzip without it
+    zstandard = None
+
+logger = create_logger(__name__)
 
 DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("sqlite:///", "")
 DATABASE_DIR = Path(os.path.dirname(os.path.abspath(DATABASE_URL)))
 
+# rows read and written at a time by the JSON export
+EXPORT_CHUNK_ROWS = 1000
+# rows inserted per statement when restoring
+RESTORE_BATCH_ROWS = 1000
+# pages copied per step of a snapshot; writers may proceed between steps
+SNAPSHOT_PAGES_PER_STEP = 1024
+
+catalog = BackupCatalog(DATABASE_DIR)
+
 
 def _timestamp():
     return datetime.datetime.now().isoformat()
 
 
-def create_backup(name: str = ""):
-    backup_file = DATABASE_DIR / f"backup_{name}@{_timestamp()}.json"
+def _backup_tables() -> list[Table]:
+    """The tables that are backed up; admin users are never part of a backup."""
+    return [model.__table__ for model in Base.__subclasses__() if model != AdminUserOrm]
+
+
+def _compression() -> str:
+    compression = os.environ.get("BACKUP_COMPRESSION", "none")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported BACKUP_COMPRESSION: '{compression}'")
+    if compression == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, compressing with gzip instead.")
+        return "gzip"
+    return compression
+
+
+def _open(path: Path, mode: str) -> IO:
+    """Open a backup file for reading or writing, compressed as its suffix says.
+
+    The mode is one of "rb", "wb", "rt" and "wt".
+    """
+    if path.suffix == ".gz":
+        return gzip.open(path, mode, **({"encoding": "utf-8"} if "t" in mode else {}))
+    if path.suffix == ".zst":
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed to read a .zst backup.")
+        raw = open(path, mode[0] + "b")
+        if "w" in mode:
+            stream = zstandard.ZstdCompressor().stream_writer(raw)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        return io.TextIOWrapper(stream, encoding="utf-8") if "t" in mode else stream
+    return open(path, mode, **({"encoding": "utf-8"} if "t" in mode else {}))
+
+
+def export_json(out: IO[str]) -> dict[str, int]:
+    """Write the backed up tables as JSON, one row per line, and return the rows
+    written per table.
+
+    All tables are read in one transaction, so the export is a consistent
+    snapshot, and rows are fetched in chunks, so memory use does not grow with
+    the size of the tables.
+    """
+    counts = {}
+    with engine.connect() as connection:
+        # the driver does not begin a transaction for reads by itself
+        connection.exec_driver_sql("BEGIN")
+        out.write("{")
+        for i, table in enumerate(_backup_tables()):
+            out.write(f'{"," if i else ""}\n{json.dumps(table.name)}: [')
+            rows = connection.execution_options(yield_per=EXPORT_CHUNK_ROWS).execute(
+                select(table)
+            )
+            counts[table.name] = 0
+            separator = "\n  "
+            for chunk in rows.mappings().partitions():
+                out.write(separator)
+                out.write(",\n  ".join(json.dumps(dict(row)) for row in chunk))
+                counts[table.name] += len(chunk)
+                separator = ",\n  "
+            out.write("\n]")
+        out.write("\n}\n")
+    return counts
+
 
-    db = SessionLocal()
+def snapshot_sqlite(target: Path) -> dict[str, int]:
+    """Copy the database to target with SQLite's online backup API, and return
+    the rows copied per table.
 
-    backup_data = {}
+    The copy is a consistent snapshot even while the database is written to,
+    and is made in steps, so writers are not locked out for the whole copy.
+    Admin users are removed from the copy.
+    """
+    if not _is_sqlite_file:
+        raise ValueError("Snapshots can only be made of an SQLite database file.")
+    with closing(sqlite3.connect(DATABASE_URL)) as source, closing(
+        sqlite3.connect(target)
+    ) as copy:
+        source.backup(copy, pages=SNAPSHOT_PAGES_PER_STEP)
+        copy.execute(f"DELETE FROM {AdminUserOrm.__tablename__}")
+        copy.commit()
+        copy.execute("VACUUM")  # leaves no trace of the deleted rows
+        return {
+            table.name: copy.execute(
+                str(select(func.count()).select_from(table))
+            ).fetchone()[0]
+            for table in _backup_tables()
+        }
 
-    for model in Base.__subclasses__():
-        if model == AdminUserOrm:
-            continue
 
-        records = db.query(model).all()
+def create_backup(name: str = "", backup_format: Optional[str] = None) -> Path:
+    """Back up the database as BACKUP_FORMAT, either json or sqlite, compressed
+    with BACKUP_COMPRESSION, either none, gzip or zstd.
 
-        # noinspection PyTypeChecker
-        serialized_records = [
-            {c.name: getattr(record, c.name) for c in model.__table__.columns}
-            for record in records
-        ]
+    The backup is added to the catalog and the backups that the retention
+    policy no longer keeps are deleted.
+    """
+    backup_format = backup_format or os.environ.get("BACKUP_FORMAT", "json")
+    if backup_format not in FORMATS:
+        raise ValueError(f"Unsupported BACKUP_FORMAT: '{backup_format}'")
+    backup_file = DATABASE_DIR / file_name(
+        f"{name}@{_timestamp()}", backup_format, _compression()
+    )
+    # written under a hidden name until complete, so it is never listed before
+    partial = backup_file.with_name("." + backup_file.name)
 
-        backup_data[model.__tablename__] = serialized_records
+    start = time.perf_counter()
+    try:
+        if backup_format == "json":
+            with _open(partial, "wt") as out:
+                rows = export_json(out)
+        else:
+            with tempfile.TemporaryDirectory(dir=DATABASE_DIR) as tmp:
+                snapshot = Path(tmp) / "snapshot.sqlite"
+                rows = snapshot_sqlite(snapshot)
+                with open(snapshot, "rb") as source, _open(partial, "wb") as out:
+                    shutil.copyfileobj(source, out)
+        partial.rename(backup_file)
+    finally:
+        partial.unlink(missing_ok=True)
+    catalog.add(describe(backup_file, rows))
+    logger.info(
+        "Created backup %s of %d bytes in %.2f s.",
+        backup_file.name,
+        backup_file.stat().st_size,
+        time.perf_counter() - start,
+    )
+    prune_backups()
+    return backup_file
 
-    with open(backup_file, "w") as f:
-        json.dump(backup_data, f, indent=2)
 
-    db.close()
+def prune_backups() -> list[str]:
+    """Delete the backups not kept by the retention policy, and return their names.
 
+    BACKUP_KEEP_LAST is the number of newest backups kept, BACKUP_KEEP_DAILY and
+    BACKUP_KEEP_WEEKLY the number of days and weeks of which the newest backup
+    is kept. All backups are kept if none of them is set.
+    """
+    expired = catalog.expired(
+        keep_last=int(os.environ.get("BACKUP_KEEP_LAST", 0)),
+        keep_daily=int(os.environ.get("BACKUP_KEEP_DAILY", 0)),
+        keep_weekly=int(os.environ.get("BACKUP_KEEP_WEEKLY", 0)),
+    )
+    for entry in expired:
+        try:
+            delete_backup(entry.name)
+        except FileNotFoundError:
+            pass  # deleted by another worker pruning at the same time
+    if expired:
+        logger.info("Deleted %d backups by the retention policy.", len(expired))
+    return [entry.name for entry in expired]
 
-def overwrite_tables(backup_data: dict, db: Session):
+
+def backup_entry(name_and_timestamp: str) -> BackupEntry:
+    """The catalog entry of a backup; raises FileNotFoundError if there is none."""
     try:
-        for table_name, records in backup_data.items():
-            model = None
-            for cls in Base.__subclasses__():
-                if cls.__tablename__ == table_name:
-                    model = cls
-                    break
+        return catalog.get(name_and_timestamp)
+    except KeyError:
+        raise FileNotFoundError(f"No backup '{name_and_timestamp}'")
+
+
+def backup_path(name_and_timestamp: str) -> Path:
+    return DATABASE_DIR / backup_entry(name_and_timestamp).file
+
+
+def read_backup(backup_file: Path) -> dict[str, list[dict]]:
+    """The rows per table of a JSON or SQLite backup."""
+    if ".sqlite" not in backup_file.suffixes:
+        with _open(backup_file, "rt") as f:
+            return json.load(f)
+    with _open_sqlite_backup(backup_file) as connection:
+        connection.row_factory = sqlite3.Row
+        return {
+            table.name: [
+                dict(row) for row in connection.execute(f"SELECT * FROM {table.name}")
+            ]
+            for table in _backup_tables()
+        }
+
+
+@contextmanager
+def _open_sqlite_backup(backup_file: Path) -> Iterator[sqlite3.Connection]:
+    """Connect to a decompressed copy of an SQLite backup."""
+    with tempfile.TemporaryDirectory(dir=DATABASE_DIR) as tmp:
+        snapshot = Path(tmp) / "snapshot.sqlite"
+        with _open(backup_file, "rb") as source, open(snapshot, "wb") as out:
+            shutil.copyfileobj(source, out)
+        with closing(sqlite3.connect(snapshot)) as connection:
+            yield connection
+
+
+class BackupSchemaError(ValueError):
+    """The backup does not match the tables of the database."""
+
+
+def validate_backup(backup_data: dict) -> list[Table]:
+    """Check the tables and columns of a backup before anything is written.
 
-            if model:
-                db.query(model).delete()
+    Returns the tables of the backup in the order they can be inserted in, each
+    after the tables its foreign keys refer to.
+    """
+    tables = {table.name: table for table in _backup_tables()}
+    unknown = set(backup_data) - set(tables)
+    if unknown:
+        raise BackupSchemaError(f"Unknown tables in backup: {', '.join(unknown)}")
+    for name, records in backup_data.items():
+        if not isinstance(records, list):
+            raise BackupSchemaError(f"The rows of '{name}' are not a list.")
+        columns = set(tables[name].columns.keys())
+        keys = set(records[0]) if records else set()
+        for i, record in enumerate(records):
+            if not isinstance(record, dict) or set(record) != keys:
+                raise BackupSchemaError(
+                    f"Row {i} of '{name}' does not have the columns of the first row."
+                )
+        if keys - columns:
+            raise BackupSchemaError(
+                f"Unknown columns in '{name}': {', '.join(keys - columns)}"
+            )
+    return [table for table in Base.metadata.sorted_tables if table.name in backup_data]
 
-                for record in records:
-                    db.add(model(**record))
 
+def overwrite_tables(backup_data: dict, db: Session) -> int:
+    """Replace the rows of the tables in the backup, and return the rows restored.
+
+    The rows are inserted in batches of RESTORE_BATCH_ROWS with executemany,
+    rather than one ORM object at a time, in a single transaction that is only
+    begun once the whole backup has been validated.
+    """
+    try:
+        tables = validate_backup(backup_data)
+        start = time.perf_counter()
+        connection = db.connection()
+        # children first, so no foreign key refers to a deleted row
+        for table in reversed(tables):
+            connection.execute(table.delete())
+        restored = 0
+        for table in tables:
+            records = backup_data[table.name]
+            for i in range(0, len(records), RESTORE_BATCH_ROWS):
+                batch = records[i : i + RESTORE_BATCH_ROWS]
+                connection.execute(table.insert(), batch)
+                restored += len(batch)
         db.commit()
+        elapsed = time.perf_counter() - start
+        taxonomy_cache.invalidate()
     except Exception as e:
         db.rollback()
         raise e
     finally:
         db.close()
+    logger.info(
+        "Restored %d rows of %d tables in %.3f s (%.0f rows/s).",
+        restored,
+        len(tables),
+        elapsed,
+        restored / elapsed if elapsed else 0,
+    )
+    return restored
 
 
-def load_backup(name_and_timestamp: str):
-    backup_file = DATABASE_DIR / f"backup_{name_and_timestamp}.json"
-    db = SessionLocal()
-    with open(backup_file, "r") as f:
-        backup_data = json.load(f)
-    overwrite_tables(backup_data, db)
+def load_backup(name_and_timestamp: str) -> int:
+    backup_data = read_backup(backup_path(name_and_timestamp))
+    return overwrite_tables(backup_data, SessionLocal())
 
 
 def delete_backup(name_and_timestamp: str):
-    os.remove(DATABASE_DIR / ("backup_" + name_and_timestamp + ".json"))
+    try:
+        entry = catalog.remove(name_and_timestamp)
+    except KeyError:
+        raise FileNotFoundError(f"No backup '{name_and_timestamp}'")
+    (DATABASE_DIR / entry.file).unlink(missing_ok=True)
+
+
+def list_backups() -> list[str]:
+    """The names and timestamps of the backups, oldest first."""
+    return [entry.name for entry in catalog.entries()]
+
+
+class BackupTooLargeError(ValueError):
+    """An uploaded backup is larger than BACKUP_MAX_UPLOAD_BYTES."""
+
+
+_magic = {"json": b"{", "sqlite": b"SQLite format 3\x00"}
+
+
+def _check_contents(path: Path, backup_format: str):
+    if path.suffix == ".zst" and zstandard is None:
+        raise ValueError("zstandard is needed to upload a .zst backup.")
+    magic = _magic[backup_format]
+    try:
+        with _open(path, "rb") as f:
+            start = f.read(len(magic) + 1024)
+    except (OSError, EOFError, ValueError) as e:
+        # gzip and zstandard raise these for data that is not theirs
+        raise ValueError(f"The backup cannot be decompressed: {e}")
+    if not start.lstrip().startswith(magic):
+        raise ValueError(f"The contents of the backup are not {backup_format}.")
+
 
+# the lines of a table in a JSON backup as written by export_json
+_json_table = re.compile(r'"((?:[^"\\]|\\.)*)": \[')
+_json_row = re.compile(r"  \{.*\},?")
 
-def list_backups():
-    backups = [
-        backup.split("_", maxsplit=1)[-1].replace(".json", "")
-        for backup in glob.glob("backup_*", root_dir=DATABASE_DIR)
-    ]
-    backups.sort(key=lambda x: x.split("@")[-1])
-    return backups
+
+def _count_json_rows(path: Path) -> Optional[dict[str, int]]:
+    # export_json writes one row per line, so the rows are counted without
+    # parsing the file; None if it is laid out otherwise
+    counts: dict[str, int] = {}
+    table = None
+    laid_out = True
+    with _open(path, "rt") as f:
+        for line in f:  # to the end, even if the rows cannot be counted
+            line = line.rstrip("\n")
+            if not laid_out:
+                continue
+            if table is not None and _json_row.fullmatch(line):
+                counts[table] += 1
+            elif match := _json_table.fullmatch(line):
+                table = json.loads(f'"{match[1]}"')
+                counts[table] = 0
+            elif line in ("]", "],"):
+                table = None
+            elif line not in ("{", "}"):
+                laid_out = False
+    return counts if laid_out else None
+
+
+def _count_sqlite_rows(path: Path) -> dict[str, int]:
+    with _open_sqlite_backup(path) as connection:
+        return {
+            table.name: connection.execute(
+                str(select(func.count()).select_from(table))
+            ).fetchone()[0]
+            for table in _backup_tables()
+        }
+
+
+def _count_rows(path: Path) -> Optional[dict[str, int]]:
+    """The rows per table of an uploaded backup, or None if they cannot be
+    counted without parsing the whole file.
+
+    The file is read to its end, so that a truncated or corrupt compressed file
+    is rejected, but rows are not loaded into memory.
+    """
+    errors = (OSError, EOFError, ValueError, sqlite3.Error)
+    if zstandard is not None:
+        errors += (zstandard.ZstdError,)
+    try:
+        if ".sqlite" in path.suffixes:
+            return _count_sqlite_rows(path)
+        return _count_json_rows(path)
+    except errors as e:
+        raise ValueError(f"The backup cannot be read: {e}")
+
+
+async def store_upload(
+    file: str, chunks: AsyncIterator[bytes], sha256: Optional[str] = None
+) -> BackupEntry:
+    """Write an uploaded backup file, chunk by chunk, and add it to the catalog.
+
+    The file name is that of a downloaded backup, e.g. backup_name@timestamp.json.gz,
+    the timestamp of the upload is used if it has none. Raises ValueError if it
+    is not a backup file, cannot be read or the checksum does not match,
+    BackupTooLargeError if it is larger than BACKUP_MAX_UPLOAD_BYTES (default
+    1 GiB) and FileExistsError if there is a backup with its name already.
+    """
+    if not file.startswith("backup_"):
+        file = "backup_" + file
+    name, backup_format, compression = parse_file_name(file)
+    if os.path.basename(file) != file or name.startswith("."):
+        raise ValueError(f"Not a backup file name: '{file}'")
+    if "@" not in name:
+        name = f"{name}@{_timestamp()}"
+    backup_file = DATABASE_DIR / file_name(name, backup_format, compression)
+    if name in catalog:
+        raise FileExistsError(f"There is a backup '{name}' already.")
+    max_bytes = int(os.environ.get("BACKUP_MAX_UPLOAD_BYTES", 1024**3))
+
+    partial = backup_file.with_name("." + backup_file.name)
+    digest, size = hashlib.sha256(), 0
+    try:
+        with open(partial, "wb") as out:
+            async for chunk in chunks:
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise BackupTooLargeError(
+                        f"The backup is larger than {max_bytes} bytes."
+                    )
+                digest.update(chunk)
+                await run_in_threadpool(out.write, chunk)
+        if sha256 and digest.hexdigest() != sha256.lower():
+            raise ValueError("The checksum of the uploaded backup does not match.")
+        await run_in_threadpool(_check_contents, partial, backup_format)
+        rows = await run_in_threadpool(_count_rows, partial)
+        partial.rename(backup_file)
+    finally:
+        partial.unlink(missing_ok=True)
+    entry = describe(backup_file, rows, sha256=digest.hexdigest())
+    catalog.add(entry)
+    logger.info("Uploaded backup %s of %d bytes.", backup_file.name, size)
+    return entry
@@ -0,0 +1,237 @@
+import datetime
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+from fastapi_camelcase import CamelModel
+
+from app.logger import create_logger
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where only one process uses the catalog
+    fcntl = None
+
+logger = create_logger(__name__)
+
+FORMATS = {"json": ".json", "sqlite": ".sqlite"}
+COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def file_name(name_and_timestamp: str, backup_format: str, compression: str) -> str:
+    return (
+        f"backup_{name_and_timestamp}{FORMATS[backup_format]}"
+        f"{COMPRESSIONS[compression]}"
+    )
+
+
+def parse_file_name(file: str) -> tuple[str, str, str]:
+    """The name and timestamp, format and compression of a backup file name.
+
+    Raises ValueError if it is not the name of a backup file.
+    """
+    if not file.startswith("backup_"):
+        raise ValueError(f"Not a backup file: '{file}'")
+    name = file.removeprefix("backup_")
+    compression = next(
+        (c for c, suffix in COMPRESSIONS.items() if suffix and name.endswith(suffix)),
+        "none",
+    )
+    name = name.removesuffix(COMPRESSIONS[compression])
+    for backup_format, suffix in FORMATS.items():
+        if name.endswith(suffix):
+            return name.removesuffix(suffix), backup_format, compression
+    raise ValueError(f"Not a backup file: '{file}'")
+
+
+def _created(name_and_timestamp: str) -> Optional[datetime.datetime]:
+    try:
+        return datetime.datetime.fromisoformat(name_and_timestamp.split("@")[-1])
+    except ValueError:
+        return None
+
+
+class BackupEntry(CamelModel):
+    name: str  # name and timestamp, the id of the backup in the API
+    file: str
+    format: str
+    compression: str
+    size: int
+    sha256: str
+    # rows per table, if known; not counted for backup files found in the directory
+    # nor for uploads not laid out as exported
+    rows: Optional[dict[str, int]] = None
+    created: datetime.datetime
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def describe(
+    path: Path, rows: Optional[dict[str, int]] = None, sha256: Optional[str] = None
+) -> BackupEntry:
+    """A catalog entry for a backup file, with its size and checksum.
+
+    The checksum is computed from the file unless it is given.
+    """
+    name, backup_format, compression = parse_file_name(path.name)
+    stat = path.stat()
+    return BackupEntry(
+        name=name,
+        file=path.name,
+        format=backup_format,
+        compression=compression,
+        size=stat.st_size,
+        sha256=sha256 or sha256_file(path),
+        rows=rows,
+        created=_created(name) or datetime.datetime.fromtimestamp(stat.st_mtime),
+    )
+
+
+class BackupCatalog:
+    """An index of the backups in a directory, kept in a manifest file.
+
+    Listing backups reads the manifest, which is only read from disk again when
+    another process has changed it, rather than scanning the directory. A
+    missing manifest is rebuilt once from the backup files in the directory.
+    Every access holds a lock on a file next to the manifest, so that the
+    workers of the application do not drop each other's changes.
+    """
+
+    def __init__(self, directory: Path, manifest: str = "backups.json"):
+        self.directory = directory
+        self.path = directory / manifest
+        self._lock = threading.Lock()
+        self._entries: Optional[dict[str, BackupEntry]] = None
+        # identifies the version of the manifest that _entries were read from
+        self._version: Optional[tuple[int, int]] = None
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            lock_file = self.path.with_name(f".{self.path.name}.lock")
+            with open(lock_file, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _scan(self) -> dict[str, BackupEntry]:
+        entries = {}
+        for file in glob.glob("backup_*", root_dir=self.directory):
+            try:
+                entry = describe(self.directory / file)
+            except ValueError:
+                continue
+            entries[entry.name] = entry
+        logger.info("Built the backup catalog from %d backup files.", len(entries))
+        return entries
+
+    def _load(self) -> dict[str, BackupEntry]:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            self._entries = self._scan()
+            self._save()
+            return self._entries
+        # the manifest is replaced rather than written to, so a change of inode
+        # shows a change even within the resolution of the modification time
+        version = (stat.st_ino, stat.st_mtime_ns)
+        if self._entries is None or version != self._version:
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+            self._entries = {
+                entry["name"]: BackupEntry.model_validate(entry)
+                for entry in manifest["backups"]
+            }
+            self._version = version
+        return self._entries
+
+    def _save(self):
+        manifest = {
+            "version": 1,
+            "backups": [
+                entry.model_dump(mode="json") for entry in self._entries.values()
+            ],
+        }
+        # replaced in one step, so readers never see half a manifest
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.directory, prefix=f".{self.path.name}.", delete=False
+        ) as f:
+            json.dump(manifest, f, indent=2)
+        try:
+            os.replace(f.name, self.path)
+        except OSError:
+            os.unlink(f.name)
+            raise
+        stat = self.path.stat()
+        self._version = (stat.st_ino, stat.st_mtime_ns)
+
+    def entries(self) -> list[BackupEntry]:
+        """The backups, oldest first."""
+        with self._locked():
+            return sorted(self._load().values(), key=lambda entry: entry.created)
+
+    def __contains__(self, name: str) -> bool:
+        with self._locked():
+            return name in self._load()
+
+    def get(self, name: str) -> BackupEntry:
+        """Raises KeyError if there is no backup with the name."""
+        with self._locked():
+            return self._load()[name]
+
+    def add(self, entry: BackupEntry):
+        with self._locked():
+            self._load()[entry.name] = entry
+            self._save()
+
+    def remove(self, name: str) -> BackupEntry:
+        """Raises KeyError if there is no backup with the name."""
+        with self._locked():
+            entry = self._load().pop(name)
+            self._save()
+            return entry
+
+    def expired(
+        self, keep_last: int = 0, keep_daily: int = 0, keep_weekly: int = 0
+    ) -> list[BackupEntry]:
+        """The backups not kept by the retention policy.
+
+        The keep_last newest backups are kept, and the newest backup of each of
+        the keep_daily newest days and keep_weekly newest weeks that have one.
+        Nothing expires if all of them are 0.
+        """
+        if not (keep_last or keep_daily or keep_weekly):
+            return []
+        newest_first = self.entries()[::-1]
+        kept = {entry.name for entry in newest_first[:keep_last]}
+        for keep, period in (
+            (keep_daily, lambda created: created.date()),
+            (keep_weekly, lambda created: created.isocalendar()[:2]),
+        ):
+            periods = set()
+            for entry in newest_first:
+                if len(periods) == keep:
+                    break
+                if period(entry.created) not in periods:
+                    periods.add(period(entry.created))
+                    kept.add(entry.name)
+        return [entry for entry in newest_first if entry.name not in kept]
@@ -1,26 +1,103 @@
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, pool, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 import dotenv
 
+from app.logger import create_logger
+
+logger = create_logger(__name__)
+
 dotenv.load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL")
 
+# SQLite settings applied to every connection; WAL lets readers proceed while an
+# admin writes, and NORMAL synchronous mode is safe in WAL mode
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "busy_timeout": os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"),  # ms
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "cache_size": os.environ.get("SQLITE_CACHE_SIZE", "-64000"),  # negative is KiB
+}
+
+
+def _pool_options() -> dict:
+    """Pool settings per process, either a queue of connections or none at all."""
+    if os.environ.get("SQLITE_POOL", "queue") == "null":
+        return {"poolclass": pool.NullPool}
+    return {
+        "pool_size": int(os.environ.get("SQLITE_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("SQLITE_MAX_OVERFLOW", 10)),
+    }
+
+
+def _set_sqlite_pragmas(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+_is_sqlite = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+_is_sqlite_file = _is_sqlite and SQLALCHEMY_DATABASE_URL not in (
+    "sqlite://",
+    "sqlite:///:memory:",
+)
+
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    **(_pool_options() if _is_sqlite_file else {}),
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# the routes use an asyncio engine, so database I/O does not block the event loop
+ASYNC_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace(
+    "sqlite://", "sqlite+aiosqlite://", 1
+)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL, **(_pool_options() if _is_sqlite_file else {})
+)
+AsyncSessionLocal = async_sessionmaker(
+    autoflush=False, expire_on_commit=False, bind=async_engine
+)
+
+if _is_sqlite:
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
 Base = declarative_base()
 
 
+def report_database_settings():
+    """Log the effective settings of the database connections."""
+    if not _is_sqlite:
+        return
+    with engine.connect() as connection:
+        effective = {
+            name: connection.execute(text(f"PRAGMA {name}")).scalar()
+            for name in SQLITE_PRAGMAS
+        }
+    logger.info(
+        "SQLite settings: %s; pool: %s",
+        ", ".join(f"{name}={value}" for name, value in effective.items()),
+        async_engine.pool.status(),
+    )
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
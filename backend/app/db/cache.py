@@ -0,0 +1,109 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, subqueryload
+
+from app.db.models import TaxonomyOrm, TaxonomyOrmItem
+from app.logger import create_logger
+
+logger = create_logger(__name__)
+
+
+def load_taxonomies(db: Session) -> dict[str, TaxonomyOrmItem]:
+    return {
+        item.name: item
+        for item in (
+            TaxonomyOrmItem.model_validate(orm)
+            for orm in db.query(TaxonomyOrm).options(subqueryload(TaxonomyOrm.group))
+        )
+    }
+
+
+class TaxonomyCache:
+    """A validated in-process snapshot of all taxonomies.
+
+    The snapshot is only rebuilt when the version has been bumped by invalidate(),
+    which must be called whenever changes to the taxonomies have been committed.
+    Since the version is local to the process, an optional max age can be set to
+    bound staleness when running several workers.
+    """
+
+    def __init__(self, max_age: Optional[float] = None):
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # invalidation may come from worker threads
+        self._rebuild_lock = asyncio.Lock()
+        self._version = 0
+        self._snapshot: Optional[dict[str, TaxonomyOrmItem]] = None
+        self._snapshot_version = -1
+        self._snapshot_time = 0.0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+        logger.debug("Taxonomy cache invalidated (version %d).", self._version)
+
+    def _is_fresh(self) -> bool:
+        if self._snapshot is None or self._snapshot_version != self._version:
+            return False
+        if self.max_age is not None:
+            return time.monotonic() - self._snapshot_time < self.max_age
+        return True
+
+    async def get(self, db: AsyncSession) -> dict[str, TaxonomyOrmItem]:
+        """Return the current snapshot, loading it from the database if stale.
+
+        The returned dict is shared between callers and must not be mutated.
+        """
+        if self._is_fresh():
+            self.hits += 1
+            return self._snapshot
+
+        async with self._rebuild_lock:
+            if self._is_fresh():  # another request rebuilt it while we waited
+                self.hits += 1
+                return self._snapshot
+
+            self.misses += 1
+            with self._lock:
+                if self._snapshot_version == self._version:
+                    # expired by max age rather than invalidated; bump so that
+                    # anything derived from the snapshot is rebuilt as well
+                    self._version += 1
+                version = self._version
+            snapshot = await db.run_sync(load_taxonomies)
+            self._snapshot = snapshot
+            self._snapshot_version = version
+            self._snapshot_time = time.monotonic()
+
+        logger.info(
+            "Taxonomy cache rebuilt with %d taxonomies (version %d, hits %d, misses %d).",
+            len(snapshot),
+            version,
+            self.hits,
+            self.misses,
+        )
+        return snapshot
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "version": self._version,
+            "size": len(self._snapshot or {}),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+_max_age = os.environ.get("TAXONOMY_CACHE_MAX_AGE")
+taxonomy_cache = TaxonomyCache(max_age=float(_max_age) if _max_age else None)
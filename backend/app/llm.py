@@ -1,11 +1,26 @@
+import asyncio
+import hashlib
+import json
 import os
-from typing import Optional
+import random
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Callable, Optional
 
+import httpx
 import ollama
+import openai
 from ollama import Options
-from openai import AsyncClient
+from openai import NOT_GIVEN, AsyncClient, DefaultAsyncHttpxClient
+from openai.types import CompletionUsage
 from openai.types.chat import ChatCompletionChunk
 
+from app import metrics
+from app.logger import create_logger
+from app.scheduler import scheduler
+
+logger = create_logger(__name__)
+
 _system_prompt = (
     "You are an expert on education and learning. Your purpose is to provide inspiration to"
     "teachers and staff in educational institutions about learning goals for courses, programs"
@@ -14,6 +29,233 @@ _system_prompt = (
 )
 
 
+def _float_env(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def max_tokens() -> int:
+    """The most tokens a response may have."""
+    return int(os.environ.get("LLM_MAX_TOKENS", 2000))
+
+
+class LlmClients:
+    """Provider clients shared by all requests in the process.
+
+    Each client keeps a pool of keep-alive connections to its provider, so they
+    should be opened once at startup and closed on shutdown rather than created
+    per request. Pool limits and timeouts are read from the environment.
+    """
+
+    def __init__(self):
+        self.openai: Optional[AsyncClient] = None
+        self.ollama: Optional[ollama.AsyncClient] = None
+
+    @staticmethod
+    def _limits() -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=int(os.environ.get("LLM_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(
+                os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 20)
+            ),
+            keepalive_expiry=_float_env("LLM_KEEPALIVE_EXPIRY", 30.0),
+        )
+
+    @staticmethod
+    def _timeout() -> httpx.Timeout:
+        return httpx.Timeout(
+            _float_env("LLM_READ_TIMEOUT", 120.0),
+            connect=_float_env("LLM_CONNECT_TIMEOUT", 10.0),
+        )
+
+    @property
+    def providers(self) -> list[str]:
+        """The providers to route requests to, set by LLM_PROVIDERS, e.g.
+        "ollama,openai". Without it, OpenAI is used if OPENAI_API_KEY is set."""
+        setting = os.environ.get("LLM_PROVIDERS")
+        if setting:
+            return [provider.strip() for provider in setting.split(",")]
+        return ["openai" if os.environ.get("OPENAI_API_KEY") else "ollama"]
+
+    @property
+    def provider(self) -> str:
+        """The preferred provider."""
+        return self.providers[0]
+
+    def model(self, model: Optional[str] = None, provider: Optional[str] = None) -> str:
+        """The model a request is sent to; Ollama always uses OLLAMA_MODEL."""
+        if (provider or self.provider) == "openai":
+            return model or "gpt-4o"
+        return os.environ.get("OLLAMA_MODEL", "llama3")
+
+    def serves(self, provider: str, model: Optional[str]) -> bool:
+        return model is None or self.model(model, provider) == model
+
+    @property
+    def is_open(self) -> bool:
+        return self.openai is not None or self.ollama is not None
+
+    def open(self):
+        if self.is_open:
+            return
+        limits, timeout = self._limits(), self._timeout()
+        for provider in self.providers:
+            if provider == "openai":
+                self.openai = AsyncClient(
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    http_client=DefaultAsyncHttpxClient(limits=limits, timeout=timeout),
+                )
+            elif provider == "ollama":
+                self.ollama = ollama.AsyncClient(limits=limits, timeout=timeout)
+            else:
+                raise ValueError(f"Unsupported LLM provider: '{provider}'")
+            logger.info(
+                "Opened %s client (max connections %s, keep-alive %s, timeout %s).",
+                provider,
+                limits.max_connections,
+                limits.max_keepalive_connections,
+                timeout.read,
+            )
+
+    async def close(self):
+        if self.openai is not None:
+            await self.openai.close()
+            self.openai = None
+        if self.ollama is not None:
+            await self.ollama._client.aclose()
+            self.ollama = None
+
+
+clients = LlmClients()
+
+
+class _Flight:
+    """A single upstream stream shared by all concurrent callers of the same request.
+
+    Chunks are buffered so that callers joining late receive the whole stream. The
+    upstream request is cancelled if every caller stops listening before it ends.
+    """
+
+    def __init__(self, key: str, upstream: AsyncIterator[str]):
+        self.key = key
+        self.upstream = upstream
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def _land(self):
+        # only remove this flight, a newer one may have taken its place
+        if _flights.get(self.key) is self:
+            del _flights[self.key]
+
+    async def _pump(self):
+        try:
+            async for chunk in self.upstream:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._land()
+            self._notify()
+            await self.upstream.aclose()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        self.subscribers += 1
+        if self.task is None:
+            self.task = asyncio.create_task(self._pump())
+        offset = 0
+        try:
+            while True:
+                changed = self.changed
+                while offset < len(self.chunks):
+                    yield self.chunks[offset]
+                    offset += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._land()
+                self.task.cancel()
+
+
+_flights: dict[str, _Flight] = {}
+_responses: dict[str, asyncio.Future] = {}
+single_flight_stats = {"upstream": 0, "coalesced": 0}
+# prompt tokens reported by the provider, and how many of them were served from its
+# prompt cache; Ollama only reports the tokens it had to evaluate
+usage_stats = {"responses": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+
+def _metric_labels(provider: str, model: Optional[str]) -> dict[str, str]:
+    return {
+        "ui_level": metrics.ui_level.get(),
+        "provider": provider,
+        "model": clients.model(model, provider),
+    }
+
+
+def _record_usage(
+    labels: dict[str, str],
+    prompt_tokens: Optional[int],
+    completion_tokens: Optional[int],
+    cached_tokens: Optional[int] = None,
+):
+    usage_stats["responses"] += 1
+    usage_stats["prompt_tokens"] += prompt_tokens or 0
+    usage_stats["cached_tokens"] += cached_tokens or 0
+    if prompt_tokens is not None:
+        metrics.prompt_tokens.observe(prompt_tokens, **labels)
+    if completion_tokens is not None:
+        metrics.completion_tokens.observe(completion_tokens, **labels)
+    logger.debug(
+        "Prompt usage: %s prompt tokens, %s cached.", prompt_tokens, cached_tokens
+    )
+
+
+def _record_openai_usage(labels: dict[str, str], usage: Optional[CompletionUsage]):
+    if usage is None:
+        return
+    # not yet part of the client's types, so it is kept as an extra field
+    details = getattr(usage, "prompt_tokens_details", None) or {}
+    if not isinstance(details, dict):
+        details = details.model_dump()
+    _record_usage(
+        labels,
+        usage.prompt_tokens,
+        usage.completion_tokens,
+        details.get("cached_tokens"),
+    )
+
+
+def response_settings(model: Optional[str] = None) -> dict:
+    """What determines a response besides the prompt and the settings of the
+    request: the model of each provider it may be routed to, and the limit of its
+    length."""
+    return {
+        "models": {
+            provider: clients.model(model, provider) for provider in clients.providers
+        },
+        "max_tokens": max_tokens(),
+    }
+
+
+def _request_key(**request) -> str:
+    serialized = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
 async def generate(
     prompt: str,
     stream: bool = False,
@@ -21,52 +263,453 @@ async def generate(
     temperature: float = None,
     frequency_penalty: float = None,
 ):
-    if os.environ.get("OPENAI_API_KEY"):
-        client = AsyncClient(api_key=os.environ.get("OPENAI_API_KEY"))
-        response_coro = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": _system_prompt},
-                {"role": "user", "content": prompt},
-            ],
-            model=model or "gpt-4o",
-            temperature=temperature,
-            frequency_penalty=frequency_penalty,
-            stream=True,
-            max_tokens=2000,
-        )
+    """Generate a response to the prompt, optionally as a stream of text chunks.
+
+    A response that is not streamed is {"response": text}, whichever provider
+    answered it.
+
+    Concurrent calls with the same prompt and settings share a single upstream
+    request unless LLM_SINGLE_FLIGHT is disabled.
+    """
+    request = dict(
+        prompt=prompt,
+        model=model,
+        temperature=temperature,
+        frequency_penalty=frequency_penalty,
+    )
+    if os.environ.get("LLM_SINGLE_FLIGHT", "true").lower() in ("false", "0"):
         if stream:
+            return _generate(stream=True, **request)
+        return await _generate(stream=False, **request)
+
+    key = _request_key(provider=clients.provider, stream=stream, **request)
+    if stream:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = _Flight(key, _generate(stream=True, **request))
+            single_flight_stats["upstream"] += 1
+        else:
+            single_flight_stats["coalesced"] += 1
+        return flight.subscribe()
+
+    response = _responses.get(key)
+    if response is None:
+        response = _responses[key] = asyncio.ensure_future(
+            _generate(stream=False, **request)
+        )
+        response.add_done_callback(lambda _: _responses.pop(key, None))
+        single_flight_stats["upstream"] += 1
+    else:
+        single_flight_stats["coalesced"] += 1
+    # one caller giving up must not cancel the request for the others
+    return await asyncio.shield(response)
+
+
+def _generate(
+    prompt: str,
+    stream: bool = False,
+    model: Optional[str] = None,
+    temperature: float = None,
+    frequency_penalty: float = None,
+):
+    clients.open()  # no-op when opened by the application lifespan
+    request = dict(
+        prompt=prompt,
+        model=model,
+        temperature=temperature,
+        frequency_penalty=frequency_penalty,
+    )
+    if stream:
+        # routed when iterated, so the stream can be registered for single-flight
+        # before anything is awaited
+        return router.stream(request)
+    return router.complete(request)
+
 
-            async def generator():
-                async for chunk in await response_coro:
+async def _generate_openai(
+    prompt: str,
+    stream: bool = False,
+    model: Optional[str] = None,
+    temperature: float = None,
+    frequency_penalty: float = None,
+):
+    labels = _metric_labels("openai", model)
+    response_coro = clients.openai.chat.completions.create(
+        messages=[
+            {"role": "system", "content": _system_prompt},
+            {"role": "user", "content": prompt},
+        ],
+        model=clients.model(model, "openai"),
+        temperature=temperature,
+        frequency_penalty=frequency_penalty,
+        stream=stream,
+        # the usage arrives in a last chunk without choices
+        stream_options={"include_usage": True} if stream else NOT_GIVEN,
+        max_tokens=max_tokens(),
+    )
+    if stream:
+
+        async def generator():
+            response = await response_coro
+            try:
+                async for chunk in response:
                     chunk: ChatCompletionChunk
+                    _record_openai_usage(labels, chunk.usage)
+                    if not chunk.choices:
+                        continue
                     prediction: Optional[str] = chunk.choices[0].delta.content
-                    if prediction is None:
-                        break
-                    yield prediction.replace("\n", "\\n")
+                    if prediction is not None:
+                        yield prediction
+            finally:
+                # hand the connection back to the pool
+                await response.close()
 
-            return generator()
-        else:
-            return await response_coro
+        return generator()
+    else:
+        response = await response_coro
+        _record_openai_usage(labels, response.usage)
+        return {"response": response.choices[0].message.content or ""}
+
+
+async def _generate_ollama(
+    prompt: str,
+    stream: bool = False,
+    model: Optional[str] = None,
+    temperature: float = None,
+    frequency_penalty: float = None,
+):
+    labels = _metric_labels("ollama", model)
+    response_coro = clients.ollama.generate(
+        prompt=prompt,
+        system=_system_prompt,
+        model=clients.model(model, "ollama"),
+        options=Options(
+            num_predict=max_tokens(),  # failsafe
+            temperature=temperature,
+            frequency_penalty=frequency_penalty,
+        ),
+        stream=stream,
+    )
+    if stream:
+
+        async def generator():
+            response = await response_coro
+            try:
+                async for chunk in response:
+                    prediction: str = chunk["response"]
+                    if chunk.get("done"):
+                        _record_usage(
+                            labels,
+                            chunk.get("prompt_eval_count"),
+                            chunk.get("eval_count"),
+                        )
+                    yield prediction
+            finally:
+                await response.aclose()
 
+        return generator()
     else:
-        response_coro = ollama.AsyncClient().generate(
-            prompt=prompt,
-            system=_system_prompt,
-            model="llama3",
-            options=Options(
-                num_predict=2000,  # failsafe
-                temperature=temperature,
-                frequency_penalty=frequency_penalty,
-            ),
-            stream=stream,
+        response = await response_coro
+        _record_usage(
+            labels, response.get("prompt_eval_count"), response.get("eval_count")
         )
-        if stream:
+        return {"response": response["response"]}
 
-            async def generator():
-                async for chunk in await response_coro:
-                    prediction: str = chunk["response"]
-                    yield prediction.replace("\n", "\\n")
 
-            return generator()
+_providers = {"openai": _generate_openai, "ollama": _generate_ollama}
+
+
+def _is_retryable(e: Exception) -> bool:
+    """Whether the request may succeed when sent again, possibly elsewhere."""
+    if isinstance(e, (httpx.TransportError, openai.APIConnectionError)):
+        return True  # includes timeouts
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    if isinstance(e, ollama.ResponseError):
+        return e.status_code == 429 or e.status_code >= 500
+    return False
+
+
+class _ProviderStats:
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        # moving average of the seconds to the first chunk or the response
+        self.latency: Optional[float] = None
+        self.failed_at = float("-inf")
+
+    def observe(self, latency: float):
+        if self.latency is None:
+            self.latency = latency
         else:
-            return await response_coro
+            self.latency = 0.8 * self.latency + 0.2 * latency
+
+
+class _Stream:
+    """A stream from a provider that counts as in flight until it is closed.
+
+    Unlike an async generator, it is also closed properly when it is discarded
+    before it has been iterated, e.g. when it lost a hedged race.
+    """
+
+    def __init__(
+        self,
+        release: Callable[[], None],
+        chunks: AsyncIterator[str],
+        labels: dict[str, str],
+    ):
+        self.release = release
+        self.chunks = chunks
+        self.labels = labels
+        self.closed = False
+        self._first: list[str] = []
+        self.received = 0
+        self.start = time.monotonic()
+        self.first_at: Optional[float] = None
+
+    async def receive_first(self):
+        try:
+            self._first.append(await anext(self.chunks))
+            self.received += 1
+        except StopAsyncIteration:
+            pass
+        self.first_at = time.monotonic()
+        metrics.time_to_first_token_seconds.observe(
+            self.first_at - self.start, **self.labels
+        )
+
+    def _observe_end(self):
+        end = time.monotonic()
+        metrics.stream_duration_seconds.observe(end - self.start, **self.labels)
+        if self.received > 1 and end > self.first_at:
+            metrics.tokens_per_second.observe(
+                (self.received - 1) / (end - self.first_at), **self.labels
+            )
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        if self._first:
+            return self._first.pop()
+        if self.closed:
+            raise StopAsyncIteration
+        try:
+            chunk = await anext(self.chunks)
+        except StopAsyncIteration:
+            self._observe_end()
+            await self.aclose()
+            raise
+        self.received += 1
+        return chunk
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.release()
+            await self.chunks.aclose()
+
+
+class ProviderRouter:
+    """Sends each request to one of the configured providers.
+
+    Providers serving the requested model are preferred, and among those the
+    policy decides: "order" keeps the order of LLM_PROVIDERS, "latency" prefers
+    the lowest average time to the first chunk and "queue" the fewest requests in
+    flight or waiting with the scheduler. Providers that failed within the last
+    cooldown seconds are only tried after the others. Failed attempts that may
+    succeed when repeated are retried up to retries times on the next provider,
+    after a jittered exponential backoff.
+
+    With hedge_after set, a second attempt is sent to the next provider if the
+    first has not produced its first chunk within hedge_after seconds, and
+    whichever responds first is kept while the other is cancelled. Requests are
+    not hedged with only one provider. Streams are only retried or hedged until
+    their first chunk has arrived.
+    """
+
+    def __init__(
+        self,
+        policy: str = "order",
+        retries: int = 2,
+        backoff: float = 0.5,
+        hedge_after: Optional[float] = None,
+        cooldown: float = 30.0,
+    ):
+        if policy not in ("order", "latency", "queue"):
+            raise ValueError(f"Unsupported LLM_ROUTING policy: '{policy}'")
+        self.policy = policy
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.cooldown = cooldown
+        self.retried = 0
+        self.hedged = 0
+        self.stats: dict[str, _ProviderStats] = {}
+
+    @classmethod
+    def from_env(cls) -> "ProviderRouter":
+        hedge_after = _float_env("LLM_HEDGE_AFTER", 0)  # ms
+        return cls(
+            policy=os.environ.get("LLM_ROUTING", "order"),
+            retries=int(os.environ.get("LLM_RETRIES", 2)),
+            backoff=_float_env("LLM_RETRY_BACKOFF", 0.5),
+            hedge_after=hedge_after / 1000 if hedge_after > 0 else None,
+            cooldown=_float_env("LLM_FAILURE_COOLDOWN", 30.0),
+        )
+
+    def _stats(self, provider: str) -> _ProviderStats:
+        if provider not in self.stats:
+            self.stats[provider] = _ProviderStats()
+        return self.stats[provider]
+
+    def candidates(self, model: Optional[str]) -> list[str]:
+        """The providers to try for a request, best first."""
+        providers = clients.providers
+        order = {provider: i for i, provider in enumerate(providers)}
+        now = time.monotonic()
+
+        def key(provider: str):
+            stats = self._stats(provider)
+            failed = now - stats.failed_at < self.cooldown
+            if self.policy == "latency":
+                rank = stats.latency or 0.0  # untried providers are tried first
+            elif self.policy == "queue":
+                rank = stats.in_flight + scheduler.waiting(provider)
+            else:
+                rank = 0
+            return failed, not clients.serves(provider, model), rank, order[provider]
+
+        return sorted(providers, key=key)
+
+    async def _attempt(self, provider: str, stream: bool, request: dict):
+        """Send the request; for streams, wait for the first chunk before returning.
+
+        The request waits for its turn with the scheduler first, and holds its slot
+        until the response or, for streams, the last chunk has been received.
+        """
+        await scheduler.acquire(provider)
+        stats = self._stats(provider)
+        stats.requests += 1
+        stats.in_flight += 1
+
+        def release():
+            stats.in_flight -= 1
+            scheduler.release(provider)
+
+        start = time.monotonic()
+        try:
+            response = await _providers[provider](stream=stream, **request)
+            if stream:
+                labels = _metric_labels(provider, request.get("model"))
+                first = _Stream(release, response, labels)
+                try:
+                    await first.receive_first()
+                except BaseException:
+                    await response.aclose()  # still counted as in flight below
+                    raise
+                stats.observe(time.monotonic() - start)
+                return first
+            stats.observe(time.monotonic() - start)
+            release()
+            return response
+        except BaseException as e:
+            release()
+            if isinstance(e, Exception):
+                stats.failures += 1
+                stats.failed_at = time.monotonic()
+            raise
+
+    @staticmethod
+    async def _discard(task: asyncio.Task):
+        task.cancel()
+        try:
+            result = await task
+        except BaseException:
+            return
+        if hasattr(result, "aclose"):
+            await result.aclose()
+
+    async def _hedged(self, provider: str, hedge: str, stream: bool, request: dict):
+        first = asyncio.ensure_future(self._attempt(provider, stream, request))
+        try:
+            done, _ = await asyncio.wait((first,), timeout=self.hedge_after)
+        except BaseException:
+            await self._discard(first)
+            raise
+        if done:
+            return first.result()
+
+        self.hedged += 1
+        logger.info(
+            "No response from %s after %d ms, hedging with %s.",
+            provider,
+            self.hedge_after * 1000,
+            hedge,
+        )
+        pending = {first, asyncio.ensure_future(self._attempt(hedge, stream, request))}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        for other in done - {task}:
+                            await self._discard(other)
+                        return winner.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                await self._discard(task)
+
+    async def _route(self, stream: bool, request: dict):
+        candidates = self.candidates(request.get("model"))
+        for attempt in range(self.retries + 1):
+            provider = candidates[attempt % len(candidates)]
+            if attempt:
+                self.retried += 1
+                await asyncio.sleep(
+                    random.uniform(0, self.backoff * 2 ** (attempt - 1))
+                )
+            try:
+                hedge = candidates[(attempt + 1) % len(candidates)]
+                if self.hedge_after is not None and hedge != provider:
+                    return await self._hedged(provider, hedge, stream, request)
+                return await self._attempt(provider, stream, request)
+            except Exception as e:
+                if attempt == self.retries or not _is_retryable(e):
+                    raise
+                logger.warning(
+                    "Request to %s failed, retrying (%d of %d): %r",
+                    provider,
+                    attempt + 1,
+                    self.retries,
+                    e,
+                )
+
+    async def complete(self, request: dict):
+        return await self._route(False, request)
+
+    async def stream(self, request: dict) -> AsyncIterator[str]:
+        async with aclosing(await self._route(True, request)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    def report(self) -> dict[str, dict]:
+        return {
+            provider: {
+                "requests": stats.requests,
+                "failures": stats.failures,
+                "in_flight": stats.in_flight,
+                "latency": stats.latency,
+            }
+            for provider, stats in self.stats.items()
+        }
+
+
+router = ProviderRouter.from_env()
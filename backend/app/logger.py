@@ -1,13 +1,169 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
 import sys
+import uuid
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+import dotenv
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# the id of the HTTP request being served, added to every record logged for it
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# attributes of every record, anything else was passed with extra=
+_record_attributes = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _record_attributes
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the message is formatted here, as its arguments may change once queued,
+        # but the output format is left to the listener
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _RequestFilter(logging.Filter):
+    """Adds the request id to records and samples debug records.
+
+    Debug records are kept for a share of LOG_DEBUG_SAMPLE_RATE of the requests,
+    chosen by their id, so the records of a request are kept or dropped together.
+    """
+
+    def __init__(self, debug_sample_rate: float):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def _sampled(self, rid: Optional[str]) -> bool:
+        if self.debug_sample_rate >= 1:
+            return True
+        if rid is None:
+            return random.random() < self.debug_sample_rate
+        return zlib.crc32(rid.encode()) % 10000 < self.debug_sample_rate * 10000
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rid = request_id.get()
+        if record.levelno <= logging.DEBUG and not self._sampled(rid):
+            return False
+        record.request_id = rid
+        return True
+
+
+_handler: Optional[logging.Handler] = None
+
+
+def _queue_handler() -> logging.Handler:
+    """The handler shared by all loggers, created on first use.
+
+    Records are put on a queue by the logging thread and written to stdout by a
+    listener thread, so logging never waits for the output on the event loop.
+    """
+    global _handler
+    if _handler is None:
+        dotenv.load_dotenv()  # loggers are created before anything else loads it
+        output = logging.StreamHandler(sys.stdout)
+        if os.environ.get("LOG_FORMAT", "json").lower() == "text":
+            output.setFormatter(
+                logging.Formatter(
+                    "%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s"
+                )
+            )
+        else:
+            output.setFormatter(JsonFormatter())
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, output)
+        listener.start()
+        atexit.register(listener.stop)  # writes the records still queued
+
+        _handler = _QueueHandler(records)
+        _handler.addFilter(
+            _RequestFilter(float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 1.0)))
+        )
+    return _handler
 
 
 def create_logger(name: str) -> logging.Logger:
-    logger = logging.getLogger(name)
-    _handler = logging.StreamHandler(sys.stdout)
-    logger.setLevel(logging.DEBUG)  # fixme
-    _handler.setFormatter(
-        logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    )
-    logger.addHandler(_handler)
-    return logger
+    """Get the logger for a module, at the level set by LOG_LEVEL (default INFO).
+
+    The handler is attached once to the top-level package, e.g. app, so that
+    every module of it logs through the same queue.
+    """
+    package = logging.getLogger(name.split(".")[0])
+    handler = _queue_handler()
+    if handler not in package.handlers:
+        package.addHandler(handler)
+        package.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        package.propagate = False
+    return logging.getLogger(name)
+
+
+class RequestIdMiddleware:
+    """Gives every HTTP request an id for its log records.
+
+    The id is taken from the X-Request-ID header if the client sent one and
+    returned in the same header of the response.
+    """
+
+    header = "x-request-id"
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        rid = None
+        for key, value in scope["headers"]:
+            if key.decode("latin-1") == self.header:
+                rid = value.decode("latin-1")[:128]
+                break
+        rid = rid or uuid.uuid4().hex
+
+        async def send_with_id(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)[self.header] = rid
+            await send(message)
+
+        token = request_id.set(rid)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
@@ -1,19 +1,37 @@
+from contextlib import asynccontextmanager
+
 import dotenv
 import os
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app import llm, tokens
+from app.db.base import report_database_settings
+from app.logger import RequestIdMiddleware
 from app.routes.auth import auth_router
 from app.routes.backup import backup_router
 from app.routes.data import data_router
 from app.routes.generate import generate_router
+from app.routes.metrics import metrics_router
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    report_database_settings()
+    llm.clients.open()
+    for provider in llm.clients.providers:
+        tokens.preload(llm.clients.model(provider=provider))
+    yield
+    await llm.clients.close()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.include_router(auth_router)
 app.include_router(data_router)
 app.include_router(generate_router)
 app.include_router(backup_router)
+app.include_router(metrics_router)
 
 dotenv.load_dotenv()
 allowed_origins = os.environ.get("ALLOWED_ORIGINS").split(",")
@@ -24,7 +42,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # readable by the UI, which is served from another origin
+    expose_headers=[
+        "X-Request-ID",
+        "X-Prompt-Prefix-Length",
+        "X-Prompt-Tokens",
+        "X-Prompt-Trimmed-Taxonomies",
+    ],
 )
+# outermost, so the id is set for everything the request does
+app.add_middleware(RequestIdMiddleware)
 
 if __name__ == "__main__":
     uvicorn.run("app.main:app", host="localhost", port=8000, reload=True)
@@ -0,0 +1,219 @@
+import bisect
+import math
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Iterator, Optional
+
+# the UI level of the generation request being served, set by the routes
+ui_level: ContextVar[str] = ContextVar("ui_level", default="")
+
+# seconds, from a prompt built from cached taxonomies to a long generation
+TIME_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+TOKEN_BUCKETS = (32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict[tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def clear(self):
+        self._values.clear()
+
+    def _samples(self) -> Iterator[str]:
+        for values, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, values)} {_format_value(value)}"
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {_escape(self.documentation)}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """Set a count that is kept elsewhere, when collected."""
+        self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = TIME_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # a count per bucket plus one for +Inf, then the sum
+            state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def _samples(self) -> Iterator[str]:
+        names = self.labels + ("le",)
+        for values, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state):
+                cumulative += count
+                labels = _format_labels(names, values + (_format_value(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, values)
+            yield f"{self.name}_sum{labels} {_format_value(state[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    """Metrics in the Prometheus text format, kept in memory by this process.
+
+    Updating a metric is a dictionary lookup and a few additions, so they can
+    be left on in production. Values that other components already keep, like
+    cache statistics, are copied into their metrics by collectors when the
+    metrics are scraped rather than on every change.
+    """
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self.metrics: list[_Metric] = []
+        self.collectors: list[Callable[[], Optional[Awaitable[None]]]] = []
+
+    def _register(self, metric: _Metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels=()) -> Counter:
+        return self._register(Counter(name, documentation, tuple(labels)))
+
+    def gauge(self, name: str, documentation: str, labels=()) -> Gauge:
+        return self._register(Gauge(name, documentation, tuple(labels)))
+
+    def histogram(
+        self, name: str, documentation: str, labels=(), buckets=TIME_BUCKETS
+    ) -> Histogram:
+        return self._register(
+            Histogram(name, documentation, tuple(labels), tuple(buckets))
+        )
+
+    def collector(self, collect: Callable[[], Optional[Awaitable[None]]]):
+        """Register a function, possibly async, that updates metrics when scraped."""
+        self.collectors.append(collect)
+        return collect
+
+    async def render(self) -> str:
+        for collect in self.collectors:
+            result = collect()
+            if result is not None:
+                await result
+        lines = [line for metric in self.metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry(prefix="ulgis_")
+
+_llm_labels = ("ui_level", "provider", "model")
+
+prompt_build_seconds = registry.histogram(
+    "prompt_build_seconds", "Time to build and fit a prompt.", ("ui_level",)
+)
+taxonomy_fetch_seconds = registry.histogram(
+    "taxonomy_fetch_seconds", "Time to get the taxonomies from the cache or database."
+)
+queue_wait_seconds = registry.histogram(
+    "llm_queue_wait_seconds",
+    "Time requests waited for a free slot with the provider.",
+    ("provider",),
+)
+time_to_first_token_seconds = registry.histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from sending a streamed request to its first chunk.",
+    _llm_labels,
+)
+stream_duration_seconds = registry.histogram(
+    "llm_stream_duration_seconds",
+    "Time from sending a streamed request to its last chunk.",
+    _llm_labels,
+)
+tokens_per_second = registry.histogram(
+    "llm_tokens_per_second",
+    "Chunks, about one token each, streamed per second after the first.",
+    _llm_labels,
+    TOKEN_RATE_BUCKETS,
+)
+prompt_tokens = registry.histogram(
+    "llm_prompt_tokens",
+    "Prompt tokens reported by the provider; Ollama leaves out cached tokens.",
+    _llm_labels,
+    TOKEN_BUCKETS,
+)
+completion_tokens = registry.histogram(
+    "llm_completion_tokens",
+    "Completion tokens reported by the provider.",
+    _llm_labels,
+    TOKEN_BUCKETS,
+)
@@ -1,5 +1,7 @@
+from typing import Annotated, Any, Optional, Union
+
 from fastapi_camelcase import CamelModel
-from pydantic import Field
+from pydantic import Discriminator, Field, Tag
 
 from app.models.custominputs import CustomInputs
 from app.models.educationinfo import (
@@ -50,6 +52,47 @@ class AmpleGenerationOptions(ModularGenerationOptions):
     llm_settings: LlmSettings = Field(title="Model Settings")
 
 
-GenerationOptions = (
-    AmpleGenerationOptions | ModularGenerationOptions | StandardGenerationOptions
-)
+ui_level_models = {
+    "Standard": StandardGenerationOptions,
+    "Modular": ModularGenerationOptions,
+    "Ample": AmpleGenerationOptions,
+}
+
+
+def _has(options: dict, field: str, alias: str) -> bool:
+    return options.get(alias, options.get(field)) is not None
+
+
+def get_ui_level(options: Any) -> Optional[str]:
+    """The UI level of generation options, which tells the models of
+    GenerationOptions apart.
+
+    Clients send it as uiLevel. For clients that do not, it is inferred from
+    the option groups only the Modular and Ample levels have.
+    """
+    if not isinstance(options, dict):
+        # the models extend each other, so their exact type is compared
+        for level, model in ui_level_models.items():
+            if type(options) is model:
+                return level
+        return None
+    if "uiLevel" in options or "ui_level" in options:
+        return options.get("uiLevel", options.get("ui_level"))
+    if _has(options, "custom_inputs", "customInputs") or _has(
+        options, "llm_settings", "llmSettings"
+    ):
+        return "Ample"
+    if _has(options, "inspiration_seeds", "inspirationSeeds"):
+        return "Modular"
+    return "Standard"
+
+
+# validated against the model of its UI level only, rather than trying each
+GenerationOptions = Annotated[
+    Union[
+        Annotated[AmpleGenerationOptions, Tag("Ample")],
+        Annotated[ModularGenerationOptions, Tag("Modular")],
+        Annotated[StandardGenerationOptions, Tag("Standard")],
+    ],
+    Discriminator(get_ui_level),
+]
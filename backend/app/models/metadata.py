@@ -1,13 +1,18 @@
+import hashlib
+import json
 from types import NoneType
-from typing import Optional, Literal, Union, Any, Callable, Type
+from typing import Optional, Literal, Union, Any, Callable, Type, NamedTuple
 
 from annotated_types import Ge, Le
+from fastapi.encoders import jsonable_encoder
 from fastapi_camelcase import CamelModel
 from pydantic import Field, field_validator, BaseModel, model_validator
 from pydantic.fields import FieldInfo  # noqa
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing_extensions import Annotated
 
+from app.db.cache import taxonomy_cache
 from app.models.generationoptions import (
     GenerationOptions,
 )
@@ -264,3 +269,46 @@ def create_metadata(model: Type[GenerationOptions], db: Session):
         for k, v in model.model_fields.items()
         if v.annotation != NoneType  #
     }
+
+
+class MetadataDocument(NamedTuple):
+    body: bytes
+    etag: str
+
+
+class MetadataCache:
+    """Serialized metadata documents per generation options model.
+
+    A document is built on first request and reused until the taxonomies change,
+    as taxonomies are the only dynamic part of the metadata.
+    """
+
+    def __init__(self):
+        self._documents: dict[type, tuple[int, MetadataDocument]] = {}
+
+    async def get(
+        self, model: Type[GenerationOptions], db: AsyncSession
+    ) -> MetadataDocument:
+        await taxonomy_cache.get(db)  # refreshes the taxonomy version if expired
+        version = taxonomy_cache.version
+        cached = self._documents.get(model)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        # same encoding as FastAPI's default JSONResponse
+        metadata = await db.run_sync(lambda session: create_metadata(model, session))
+        body = json.dumps(
+            jsonable_encoder(metadata),
+            ensure_ascii=False,
+            allow_nan=False,
+            indent=None,
+            separators=(",", ":"),
+        ).encode("utf-8")
+        document = MetadataDocument(
+            body=body, etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        )
+        self._documents[model] = (version, document)
+        return document
+
+
+metadata_cache = MetadataCache()
@@ -30,15 +30,15 @@ class StandardTaxonomyArray(ToggledOptionGroupArray):
         title="No Taxonomy",
         description="By toggling this, no background taxonomy is considered.",
     )
+    # the taxonomies by name, validated along with the array
+    __pydantic_extra__: dict[str, Taxonomy]
 
     def is_any_enabled(self) -> bool:
         # the "none" taxonomy is not checked since it will not be part of iter_taxonomies()
         return any(taxonomy.enabled for _, taxonomy in self.iter_taxonomies())
 
     def iter_taxonomies(self) -> Iterable[tuple[str, Taxonomy]]:
-        return (
-            (name, Taxonomy.model_validate(d)) for name, d in self.model_extra.items()
-        )
+        return iter(self.model_extra.items())
 
 
 class ModularTaxonomyArray(StandardTaxonomyArray):
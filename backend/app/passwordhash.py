@@ -1,7 +1,19 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 from passlib.context import CryptContext
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt takes a few hundred milliseconds on purpose; hashing runs on its own few
+# threads (bcrypt releases the GIL), so it neither blocks the event loop nor
+# takes up the threads that serve sync routes
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PASSWORD_HASH_WORKERS", 2)),
+    thread_name_prefix="passwordhash",
+)
+
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -9,3 +21,17 @@ def verify_password(plain_password, hashed_password):
 
 def get_password_hash(password):
     return pwd_context.hash(password)
+
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    """verify_password on the password hashing threads."""
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, verify_password, plain_password, hashed_password
+    )
+
+
+async def get_password_hash_async(password) -> str:
+    """get_password_hash on the password hashing threads."""
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, get_password_hash, password
+    )
@@ -1,3 +1,6 @@
+import os
+from typing import Collection, NamedTuple, Optional
+
 from app.db.models import StepType, TaxonomyOrmItem
 from app.models.generationoptions import (
     GenerationOptions,
@@ -5,53 +8,155 @@ from app.models.generationoptions import (
     ModularGenerationOptions,
 )
 from app.models.educationinfo import ModularEducationInfo
+from app.models.taxonomies import Taxonomy
+from app.logger import create_logger
+from app.tokens import count_tokens
 
+logger = create_logger(__name__)
 
-def build_prompt(
-    options: GenerationOptions, taxonomies_info: dict[str, TaxonomyOrmItem]
+# fixed segments of the prompt
+_BACKGROUND_INTRO = (
+    "Below are descriptions of educational taxonomies as background information:\n\n"
+)
+_CUSTOM_INPUTS_INTRO = "Also pay heed to the following information:\n\n"
+_COMPETENCY_INTRO = (
+    "Your response should be based on the provided taxonomies where you aim for the following levels of "
+    "competency for the described aspects:"
+    "\n"
+)
+_LEARNING_GOALS = (
+    "define clear and broad learning goals that outline the general knowledge, "
+    "skills, and competencies students are expected to develop. These should "
+    "be aligned with the overall educational objectives and provide a foundation "
+    "for the specific learning outcomes."
+)
+_LEARNING_OUTCOMES = (
+    "specify detailed and measurable learning outcomes that describe the specific "
+    "knowledge, skills, and abilities students should demonstrate. These should be "
+    "precise, observable, and directly linked to the assessment methods used."
+)
+_CURRICULUM_COMPETENCY_PROFILE = (
+    "develop a comprehensive curriculum competency profile that outlines the key "
+    "competencies students are expected "
+    "to acquire by the time they graduate. This profile should encompass a broad "
+    "range of skills, knowledge, and attitudes across all courses, reflecting "
+    "the program’s core objectives and aligning with industry standards and "
+    "professional requirements."
+)
+_STEPS = {step_type: step_type.steps() for step_type in StepType}
+
+
+# "default" keeps the original order of the prompt, "prefix" puts everything that
+# only depends on the taxonomies first, so providers can reuse a cached prefix
+PROMPT_LAYOUT = os.environ.get("PROMPT_LAYOUT", "default")
+# prompts above this many tokens are trimmed, 0 disables the budget
+PROMPT_MAX_TOKENS = int(os.environ.get("PROMPT_MAX_TOKENS", 0))
+
+
+class CompiledPrompt(NamedTuple):
+    text: str
+    # length of the start of text shared with other prompts for the same taxonomies
+    prefix_length: int
+    tokens: Optional[int] = None
+    # taxonomies whose background was condensed to fit the token budget
+    trimmed: tuple[str, ...] = ()
+
+
+def _background_segment(
+    name: str, taxonomy: TaxonomyOrmItem, summarized: bool = False
 ) -> str:
-    prompt = ""
+    text = taxonomy.short_description if summarized else taxonomy.text
+    return f"Title: {name}\n\n{text}\n\n"
 
-    # background knowledge
-    if options.taxonomies.is_any_enabled():
-        prompt += "Below are descriptions of educational taxonomies as background information:\n\n"
-        for taxonomy_name, taxonomy_params in options.taxonomies.iter_taxonomies():
-            if not taxonomy_params.enabled:
-                continue
-            prompt += f"Title: {taxonomy_name}\n\n"
-            prompt += f"{taxonomies_info[taxonomy_name].text}"
-            prompt += "\n\n"
-
-    # custom inputs
+
+def _competency_segment(param_name: str, value: int, step_type: StepType) -> str:
+    if value == 0:
+        return f"\t- Ignore '{param_name}'.\n"
+    elif step_type == StepType.ATTENTION:
+        return f"\t- Pay {_STEPS[step_type][value]} to '{param_name}'.\n"
+    elif step_type == StepType.LEVEL:
+        return f"\t- Aim for a {_STEPS[step_type][value]} level for '{param_name}'.\n"
+    return ""
+
+
+def _competency_segments(
+    enabled_taxonomies: list[tuple[str, Taxonomy]],
+    taxonomies_info: dict[str, TaxonomyOrmItem],
+) -> list[str]:
+    segments = []
+    for taxonomy_name, taxonomy_params in enabled_taxonomies:
+        segments.append(f"- {taxonomy_name}\n")
+        step_type = taxonomies_info[taxonomy_name].step_type
+        for param_name, param_value in taxonomy_params.iter_options():
+            segments.append(_competency_segment(param_name, param_value, step_type))
+    if enabled_taxonomies:
+        segments.append("\n\n")
+    return segments
+
+
+def _custom_input_segments(options: GenerationOptions) -> list[str]:
+    segments = []
     if (
         isinstance(options, AmpleGenerationOptions)
         and options.custom_inputs.extra_inputs
     ):
-        prompt += "Also pay heed to the following information:\n\n"
+        segments.append(_CUSTOM_INPUTS_INTRO)
         for value in options.custom_inputs.extra_inputs:
             if value:
-                prompt += f"{value}:\n\n"
+                segments.append(f"{value}:\n\n")
+    return segments
 
-    if options.taxonomies.is_any_enabled():
-        prompt += (
-            "Your response should be based on the provided taxonomies where you aim for the following levels of "
-            "competency for the described aspects:"
-        )
-        prompt += "\n"
-        for taxonomy_name, taxonomy_params in options.taxonomies.iter_taxonomies():
-            if not taxonomy_params.enabled:
-                continue
-            prompt += f"- {taxonomy_name}\n"
-            step_type = taxonomies_info[taxonomy_name].step_type
-            for param_name, param_value in taxonomy_params.iter_options():
-                if param_value == 0:
-                    prompt += f"\t- Ignore '{param_name}'.\n"
-                elif step_type == StepType.ATTENTION:
-                    prompt += f"\t- Pay {StepType.ATTENTION.steps()[param_value]} to '{param_name}'.\n"
-                elif step_type == StepType.LEVEL:
-                    prompt += f"\t- Aim for a {StepType.LEVEL.steps()[param_value]} level for '{param_name}'.\n"
-
-        prompt += "\n\n"
+
+def build_prompt(
+    options: GenerationOptions, taxonomies_info: dict[str, TaxonomyOrmItem]
+) -> str:
+    return compile_prompt(options, taxonomies_info).text
+
+
+def compile_prompt(
+    options: GenerationOptions,
+    taxonomies_info: dict[str, TaxonomyOrmItem],
+    layout: Optional[str] = None,
+    summarized: Collection[str] = (),
+    omitted: Collection[str] = (),
+) -> CompiledPrompt:
+    """Build the prompt, optionally summarizing or omitting taxonomy backgrounds."""
+    layout = layout or PROMPT_LAYOUT
+    segments: list[str] = []
+
+    enabled_taxonomies = [
+        (name, params)
+        for name, params in options.taxonomies.iter_taxonomies()
+        if params.enabled
+    ]
+    if layout == "prefix":
+        enabled_taxonomies.sort(key=lambda taxonomy: taxonomy[0])
+
+    # background knowledge
+    backgrounds = [name for name, _ in enabled_taxonomies if name not in omitted]
+    if backgrounds:
+        segments.append(_BACKGROUND_INTRO)
+        for taxonomy_name in backgrounds:
+            segments.append(
+                _background_segment(
+                    taxonomy_name,
+                    taxonomies_info[taxonomy_name],
+                    summarized=taxonomy_name in summarized,
+                )
+            )
+
+    if layout == "prefix":
+        if enabled_taxonomies:
+            segments.append(_COMPETENCY_INTRO)
+        prefix_length = sum(map(len, segments))
+        segments.extend(_competency_segments(enabled_taxonomies, taxonomies_info))
+        segments.extend(_custom_input_segments(options))
+    else:
+        prefix_length = sum(map(len, segments))
+        segments.extend(_custom_input_segments(options))
+        if enabled_taxonomies:
+            segments.append(_COMPETENCY_INTRO)
+        segments.extend(_competency_segments(enabled_taxonomies, taxonomies_info))
 
     target_type = (options.education_info.target_type or "education").lower()
     target_name = options.education_info.target_name.strip()
@@ -61,62 +166,45 @@ def build_prompt(
         level = options.education_info.education_level + " level"
 
     if options.education_info.context_description:
-        prompt += "\n\n"
-        prompt += (
+        segments.append(
+            "\n\n"
             f"Your response should fit with the {target_type}"
             f"{' called ' + target_name if target_name else ''} at {level}"
             " where you take into account the following contextual information: "
             f"{options.education_info.context_description}"
+            "\n\n"
         )
 
-        prompt += "\n\n"
-
     if (
         isinstance(options.education_info, ModularEducationInfo)
         and options.education_info.previous_learning_goals
     ):
-        prompt += "Take into account these previous learning goals:\n"
-        prompt += options.education_info.previous_learning_goals
-        prompt += "\n\n"
+        segments.append("Take into account these previous learning goals:\n")
+        segments.append(options.education_info.previous_learning_goals)
+        segments.append("\n\n")
 
     if (
         isinstance(options, AmpleGenerationOptions)
         and options.custom_inputs.custom_instruction
     ):
-        prompt += options.custom_inputs.custom_instruction
-        prompt += "\n\n"
+        segments.append(options.custom_inputs.custom_instruction)
+        segments.append("\n\n")
 
     # output formatting
     if target_name:
-        prompt += f"For the {target_type} {target_name} at {level}, "
+        segments.append(f"For the {target_type} {target_name} at {level}, ")
     else:
-        prompt += f"For any {target_type} at {level}, "
+        segments.append(f"For any {target_type} at {level}, ")
 
     if options.output_options.learning_goals.enabled:
-        prompt += (
-            "define clear and broad learning goals that outline the general knowledge, "
-            "skills, and competencies students are expected to develop. These should "
-            "be aligned with the overall educational objectives and provide a foundation "
-            "for the specific learning outcomes."
-        )
+        segments.append(_LEARNING_GOALS)
     elif options.output_options.learning_outcomes.enabled:
-        prompt += (
-            "specify detailed and measurable learning outcomes that describe the specific "
-            "knowledge, skills, and abilities students should demonstrate. These should be "
-            "precise, observable, and directly linked to the assessment methods used."
-        )
+        segments.append(_LEARNING_OUTCOMES)
     elif options.output_options.competency_profile.enabled:
         if target_type == "education" or target_type == "programme":
-            prompt += (
-                "develop a comprehensive curriculum competency profile that outlines the key "
-                "competencies students are expected "
-                "to acquire by the time they graduate. This profile should encompass a broad "
-                "range of skills, knowledge, and attitudes across all courses, reflecting "
-                "the program’s core objectives and aligning with industry standards and "
-                "professional requirements."
-            )
+            segments.append(_CURRICULUM_COMPETENCY_PROFILE)
         else:
-            prompt += (
+            segments.append(
                 "create a detailed competency profile that identifies the essential skills, "
                 "knowledge, and attitudes students are expected to develop. This profile should "
                 "align with the broader program competencies while focusing on the unique "
@@ -124,14 +212,71 @@ def build_prompt(
                 "progression and practical application."
             )
 
-    prompt += "\n\n"
+    segments.append("\n\n")
 
     if (
         isinstance(options, ModularGenerationOptions)
         and options.inspiration_seeds.keywords
     ):
-        prompt += "Use these keywords as seed for inspiration: " + ", ".join(
-            options.inspiration_seeds.keywords
+        segments.append(
+            "Use these keywords as seed for inspiration: "
+            + ", ".join(options.inspiration_seeds.keywords)
         )
 
-    return prompt.strip()
+    text = "".join(segments).strip()
+    return CompiledPrompt(text, min(prefix_length, len(text)))
+
+
+def fit_prompt(
+    options: GenerationOptions,
+    taxonomies_info: dict[str, TaxonomyOrmItem],
+    model: str,
+    max_tokens: Optional[int] = None,
+) -> CompiledPrompt:
+    """Build the prompt and count its tokens, trimming it to fit max_tokens.
+
+    The backgrounds of the enabled taxonomies are trimmed in order of ascending
+    priority, first by replacing their text with the short description and then by
+    leaving them out. The competency levels and the user's inputs are always kept.
+    """
+    max_tokens = PROMPT_MAX_TOKENS if max_tokens is None else max_tokens
+    prompt = compile_prompt(options, taxonomies_info)
+    tokens = count_tokens(prompt.text, model)
+    if not max_tokens or tokens <= max_tokens:
+        return prompt._replace(tokens=tokens)
+
+    candidates = sorted(
+        (
+            name
+            for name, params in options.taxonomies.iter_taxonomies()
+            if params.enabled
+        ),
+        key=lambda name: taxonomies_info[name].priority,
+    )
+    untrimmed_tokens = tokens
+    summarized: list[str] = []
+    omitted: list[str] = []
+    for trimmed, name in [(summarized, name) for name in candidates] + [
+        (omitted, name) for name in candidates
+    ]:
+        trimmed.append(name)
+        prompt = compile_prompt(
+            options, taxonomies_info, summarized=summarized, omitted=omitted
+        )
+        tokens = count_tokens(prompt.text, model)
+        if tokens <= max_tokens:
+            break
+
+    logger.info(
+        "Trimmed prompt from %d to %d tokens (budget %d), summarized %s, omitted %s.",
+        untrimmed_tokens,
+        tokens,
+        max_tokens,
+        summarized,
+        omitted,
+    )
+    if tokens > max_tokens:
+        logger.warning(
+            "Prompt of %d tokens exceeds the budget of %d.", tokens, max_tokens
+        )
+    return prompt._replace(tokens=tokens, trimmed=tuple(summarized))
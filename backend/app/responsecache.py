@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from pathlib import Path
+from typing import Any, AsyncIterator, NamedTuple, Optional
+
+from app.logger import create_logger
+
+logger = create_logger(__name__)
+
+
+class _Entry(NamedTuple):
+    value: Any
+    size: int
+    created: float
+
+
+class ResponseCache:
+    """LRU cache of generated responses keyed by a hash of the prompt and settings.
+
+    Entries expire after ttl seconds and the cache holds at most max_bytes of
+    serialized responses. If a directory is given, entries are also written to
+    disk so they survive restarts and can be shared between workers. A cache with
+    max_bytes set to 0 is disabled.
+
+    The size of the directory is tracked as entries are written, and it is only
+    scanned and pruned when that size exceeds max_bytes or every prune_interval
+    seconds, which accounts for the files written by other workers. Pruning
+    removes the oldest files until the directory is below prune_ratio of
+    max_bytes, so that it is not scanned again on the next write.
+    """
+
+    prune_interval = 60.0
+    prune_ratio = 0.9
+
+    def __init__(
+        self, max_bytes: int = 0, ttl: float = 3600.0, directory: Optional[str] = None
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = Path(directory) if directory else None
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        # bytes in the directory as of the last scan plus those written since;
+        # None until it is first scanned
+        self._directory_size: Optional[int] = None
+        self._scanned = 0.0
+        if self.enabled and self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        return cls(
+            max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 0)),
+            ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 3600.0)),
+            directory=os.environ.get("RESPONSE_CACHE_DIR"),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(**request: Any) -> str:
+        """Hash everything that determines a response, e.g. prompt and model settings."""
+        serialized = json.dumps(request, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created: float) -> bool:
+        return time.time() - created > self.ttl
+
+    def _store(self, key: str, entry: _Entry):
+        if key in self._entries:
+            self.size -= self._entries.pop(key).size
+        self._entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def _read_file(self, key: str) -> Optional[_Entry]:
+        path = self.directory / f"{key}.json"
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if self._is_expired(data["created"]):
+            path.unlink(missing_ok=True)
+            return None
+        return _Entry(data["value"], path.stat().st_size, data["created"])
+
+    def _write_file(self, key: str, entry: _Entry):
+        path = self.directory / f"{key}.json"
+        data = json.dumps({"created": entry.created, "value": entry.value}).encode()
+        # unique, so that workers writing the same entry do not collide
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=self.directory, prefix=f".{key}.", suffix=".tmp", delete=False
+        ) as f:
+            f.write(data)
+        try:
+            os.replace(f.name, path)  # atomic, so readers never see partial files
+        except OSError:
+            os.unlink(f.name)
+            raise
+        if self._directory_size is not None:
+            # an entry written again is counted twice until the next scan
+            self._directory_size += len(data)
+        if (
+            self._directory_size is None
+            or self._directory_size > self.max_bytes
+            or time.time() - self._scanned > self.prune_interval
+        ):
+            self._prune_directory()
+
+    def _prune_directory(self):
+        files = []
+        for path in self.directory.glob("*.json"):
+            try:
+                files.append((path, path.stat()))
+            except FileNotFoundError:  # removed by another worker
+                pass
+        files.sort(key=lambda file: file[1].st_mtime)
+        total = sum(stat.st_size for _, stat in files)
+        if total > self.max_bytes:
+            for path, stat in files:
+                if total <= self.max_bytes * self.prune_ratio:
+                    break
+                total -= stat.st_size
+                path.unlink(missing_ok=True)
+        self._directory_size = total
+        self._scanned = time.time()
+
+    async def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and self._is_expired(entry.created):
+            self.size -= self._entries.pop(key).size
+            entry = None
+        if entry is None and self.directory:
+            entry = await asyncio.to_thread(self._read_file, key)
+            if entry is not None:
+                self._store(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    async def put(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        entry = _Entry(value, size, time.time())
+        self._store(key, entry)
+        if self.directory:
+            await asyncio.to_thread(self._write_file, key, entry)
+
+    async def record(self, key: str, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Pass the stream through and cache its chunks if it runs to completion."""
+        chunks = []
+        async with aclosing(stream):
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        await self.put(key, chunks)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+async def replay(chunks: list[str]) -> AsyncIterator[str]:
+    for chunk in chunks:
+        yield chunk
+
+
+response_cache = ResponseCache.from_env()
@@ -1,6 +1,8 @@
 import os
+import threading
+import time
 from datetime import datetime, timedelta, timezone
-from typing import Annotated
+from typing import Annotated, Optional
 
 import dotenv
 import jwt
@@ -9,12 +11,13 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi_camelcase import CamelModel
 from jwt.exceptions import InvalidTokenError
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import passwordhash
-from app.db.base import get_db
+from app.db.base import get_async_db
 from app.db.models import AdminUserOrm
-from app.passwordhash import verify_password
+from app.passwordhash import verify_password_async
 
 auth_router = APIRouter(prefix="/auth")
 
@@ -30,18 +33,18 @@ except KeyError:
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
 
-def get_user(db, username: str):
-    user = db.query(AdminUserOrm).filter(AdminUserOrm.name == username).first()
+async def get_user(db: AsyncSession, username: str):
+    user = await db.scalar(select(AdminUserOrm).where(AdminUserOrm.name == username))
     if user is None:
         return None
     return user
 
 
-def authenticate_user(db, username: str, password: str):
-    user = get_user(db, username)
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.password_hash):
+    if not await verify_password_async(password, user.password_hash):
         return False
     return user
 
@@ -57,10 +60,78 @@ def create_access_token(data: dict, expires_delta: timedelta):
     return encoded_jwt
 
 
-@auth_router.get("/current_user", response_model=str)
-async def get_current_user(
-    token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)
-):
+class AdminPrincipal(CamelModel):
+    """The admin user a valid access token was issued to."""
+
+    id: int
+    name: str
+
+
+class PrincipalCache:
+    """The admins resolved from access tokens, kept until the tokens expire.
+
+    A token is decoded and its admin looked up in the database only the first
+    time it is seen, not on every request. Entries are dropped when the
+    password of their admin is changed.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._principals: dict[str, tuple[AdminPrincipal, float]] = {}
+
+    def get(self, token: str) -> Optional[AdminPrincipal]:
+        with self._lock:
+            principal, expires = self._principals.get(token, (None, 0.0))
+            if principal is not None and expires <= time.time():
+                del self._principals[token]
+                principal = None
+            if principal is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return principal
+
+    def put(self, token: str, principal: AdminPrincipal, expires: float):
+        with self._lock:
+            if len(self._principals) >= self.max_entries:
+                now = time.time()
+                for key, (_, key_expires) in list(self._principals.items()):
+                    if key_expires <= now:
+                        del self._principals[key]
+                if len(self._principals) >= self.max_entries:
+                    # the oldest entry, dicts keep the order of insertion
+                    del self._principals[next(iter(self._principals))]
+            self._principals[token] = (principal, expires)
+
+    def invalidate(self, name: str):
+        with self._lock:
+            for token, (principal, _) in list(self._principals.items()):
+                if principal.name == name:
+                    del self._principals[token]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._principals),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+principal_cache = PrincipalCache()
+
+
+async def get_current_admin(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    db: AsyncSession = Depends(get_async_db),
+) -> AdminPrincipal:
+    """Dependency of the routes for admins, raises 401 for an invalid token."""
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -73,10 +144,19 @@ async def get_current_user(
             raise credentials_exception
     except InvalidTokenError:
         raise credentials_exception
-    user = get_user(db, username=username)
+    user = await get_user(db, username=username)
     if user is None:
         raise credentials_exception
-    return user.name
+    principal = AdminPrincipal(id=user.id, name=user.name)
+    principal_cache.put(token, principal, payload.get("exp", 0))
+    return principal
+
+
+@auth_router.get("/current_user", response_model=str)
+async def get_current_user(
+    admin: Annotated[AdminPrincipal, Depends(get_current_admin)],
+):
+    return admin.name
 
 
 class PasswordChange(CamelModel):
@@ -88,18 +168,21 @@ class PasswordChange(CamelModel):
 @auth_router.post("/set_password")
 async def set_password(
     form_data: PasswordChange,
-    token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(get_db),
+    admin: Annotated[AdminPrincipal, Depends(get_current_admin)],
+    db: AsyncSession = Depends(get_async_db),
 ):
-    user = authenticate_user(db, form_data.username, form_data.old_password)
+    user = await authenticate_user(db, form_data.username, form_data.old_password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    user.password_hash = passwordhash.get_password_hash(form_data.new_password)
-    db.commit()
+    user.password_hash = await passwordhash.get_password_hash_async(
+        form_data.new_password
+    )
+    await db.commit()
+    principal_cache.invalidate(user.name)
 
 
 class Token(BaseModel):
@@ -110,9 +193,9 @@ class Token(BaseModel):
 @auth_router.post("/token")
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ) -> Token:
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
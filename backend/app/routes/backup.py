@@ -1,8 +1,12 @@
-from fastapi import Depends, APIRouter, status
+from typing import Optional
+
+from fastapi import Depends, APIRouter, HTTPException, Request, status
+from fastapi.responses import FileResponse
 
 from app.db import backup
+from app.db.backupcatalog import BackupEntry
 from app.logger import create_logger
-from app.routes.auth import oauth2_scheme
+from app.routes.auth import AdminPrincipal, get_current_admin
 
 logger = create_logger(__name__)
 
@@ -10,22 +14,89 @@ backup_router = APIRouter(prefix="/backup")
 
 
 @backup_router.post("/create/{name}", status_code=status.HTTP_201_CREATED)
-def create(name: str, token: str = Depends(oauth2_scheme)):
+def create(name: str, admin: AdminPrincipal = Depends(get_current_admin)):
     backup.create_backup(name)
 
 
 @backup_router.get("/list", response_model=list[str])
-def list_backups(token: str = Depends(oauth2_scheme)):
+def list_backups(admin: AdminPrincipal = Depends(get_current_admin)):
     return backup.list_backups()
 
 
+@backup_router.get("/catalog", response_model=list[BackupEntry])
+def catalog(admin: AdminPrincipal = Depends(get_current_admin)):
+    return backup.catalog.entries()
+
+
 @backup_router.delete(
     "/delete/{name_and_timestamp}", status_code=status.HTTP_204_NO_CONTENT
 )
-def delete_backup(name_and_timestamp: str, token: str = Depends(oauth2_scheme)):
-    backup.delete_backup(name_and_timestamp)
+def delete_backup(
+    name_and_timestamp: str, admin: AdminPrincipal = Depends(get_current_admin)
+):
+    try:
+        backup.delete_backup(name_and_timestamp)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+
+@backup_router.get("/download/{name_and_timestamp}", response_class=FileResponse)
+def download(
+    name_and_timestamp: str, admin: AdminPrincipal = Depends(get_current_admin)
+):
+    try:
+        entry = backup.backup_entry(name_and_timestamp)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    # sent from disk in chunks, with the checksum to verify the download against
+    return FileResponse(
+        backup.DATABASE_DIR / entry.file,
+        filename=entry.file,
+        media_type="application/octet-stream",
+        headers={"ETag": f'"{entry.sha256}"', "X-Checksum-SHA256": entry.sha256},
+    )
+
+
+@backup_router.post(
+    "/upload",
+    status_code=status.HTTP_201_CREATED,
+    response_model=BackupEntry,
+)
+async def upload(
+    request: Request,
+    filename: str,
+    sha256: Optional[str] = None,
+    admin: AdminPrincipal = Depends(get_current_admin),
+):
+    """Upload a backup file as the request body, e.g. one downloaded before.
+
+    The body is written to disk as it is received, never held in memory whole.
+    """
+    try:
+        return await backup.store_upload(filename, request.stream(), sha256)
+    except FileExistsError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except backup.BackupTooLargeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e)
+        )
+    except ValueError as e:
+        logger.warning("Not storing uploaded backup %s: %s", filename, e)
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
 
 
 @backup_router.post("/restore/{name_and_timestamp}")
-def load_backup(name_and_timestamp: str, token: str = Depends(oauth2_scheme)):
-    backup.load_backup(name_and_timestamp)
+def load_backup(
+    name_and_timestamp: str, admin: AdminPrincipal = Depends(get_current_admin)
+):
+    try:
+        backup.load_backup(name_and_timestamp)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except backup.BackupSchemaError as e:
+        logger.warning("Not restoring backup %s: %s", name_and_timestamp, e)
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
@@ -1,11 +1,12 @@
 from typing import cast
 
 from fastapi import Depends, APIRouter, HTTPException, Response, status
-from sqlalchemy import ColumnElement
+from sqlalchemy import ColumnElement, select
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session, subqueryload
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db.base import get_db
+from app.db.base import get_async_db
+from app.db.cache import taxonomy_cache
 from app.db.models import (
     TaxonomyOrm,
     TextContentOrm,
@@ -14,7 +15,7 @@ from app.db.models import (
     ParameterOrm,
 )
 from app.logger import create_logger
-from app.routes.auth import oauth2_scheme
+from app.routes.auth import AdminPrincipal, get_current_admin
 
 logger = create_logger(__name__)
 
@@ -22,26 +23,23 @@ data_router = APIRouter(prefix="/data")
 
 
 @data_router.get("/taxonomies", response_model=list[TaxonomyOrmItem])
-def get_taxonomies(db: Session = Depends(get_db)):
-    return [
-        TaxonomyOrmItem.model_validate(item)
-        for item in db.query(TaxonomyOrm).options(subqueryload(TaxonomyOrm.group)).all()
-    ]
+async def get_taxonomies(db: AsyncSession = Depends(get_async_db)):
+    return list((await taxonomy_cache.get(db)).values())
 
 
 @data_router.put("/taxonomies", response_model=None)
-def put_or_update_taxonomy(
+async def put_or_update_taxonomy(
     arg_obj: TaxonomyOrmItem,
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
+    admin: AdminPrincipal = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Add or update a taxonomy object in the database."""
     try:
         # Check if the taxonomy already exists
-        existing = (
-            db.query(TaxonomyOrm)
-            .filter(cast(ColumnElement[bool], TaxonomyOrm.name == arg_obj.name))
-            .first()
+        existing = await db.scalar(
+            select(TaxonomyOrm).where(
+                cast(ColumnElement[bool], TaxonomyOrm.name == arg_obj.name)
+            )
         )
 
         # Prepare the object to be created or updated
@@ -54,8 +52,9 @@ def put_or_update_taxonomy(
         else:
             operation = "created"
 
-        db.merge(obj)  # Merge to update or insert the object
-        db.commit()
+        await db.merge(obj)  # Merge to update or insert the object
+        await db.commit()
+        taxonomy_cache.invalidate()
 
         # Return appropriate response
         if operation == "created":
@@ -64,67 +63,73 @@ def put_or_update_taxonomy(
             return Response(status_code=status.HTTP_204_NO_CONTENT)
 
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @data_router.delete("/taxonomies/{taxonomy_id}", response_model=None)
-def delete_taxonomy(
-    taxonomy_id: int, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
+async def delete_taxonomy(
+    taxonomy_id: int,
+    admin: AdminPrincipal = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_async_db),
 ):
     try:
-        existing = (
-            db.query(TaxonomyOrm)
-            .filter(cast(ColumnElement[bool], TaxonomyOrm.id == taxonomy_id))
-            .first()
+        existing = await db.scalar(
+            select(TaxonomyOrm).where(
+                cast(ColumnElement[bool], TaxonomyOrm.id == taxonomy_id)
+            )
         )
-        db.delete(existing)
-        db.commit()
+        await db.delete(existing)
+        await db.commit()
+        taxonomy_cache.invalidate()
         return True
     except SQLAlchemyError as e:
-        db.rollback()  # Rollback in case of an error
+        await db.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @data_router.get("/text_content")
-def get_text_content_all(db: Session = Depends(get_db)):
+async def get_text_content_all(db: AsyncSession = Depends(get_async_db)):
     return [
-        TextContentItem.model_validate(item) for item in db.query(TextContentOrm).all()
+        TextContentItem.model_validate(item)
+        for item in await db.scalars(select(TextContentOrm))
     ]
 
 
 @data_router.get("/text_content/{name}")
-def get_text_content(name: str, db: Session = Depends(get_db)):
+async def get_text_content(name: str, db: AsyncSession = Depends(get_async_db)):
     row = (
-        db.query(TextContentOrm)
-        .filter(cast(ColumnElement[bool], TextContentOrm.name == name))
-        .one_or_none()
-    )
+        await db.scalars(
+            select(TextContentOrm).where(
+                cast(ColumnElement[bool], TextContentOrm.name == name)
+            )
+        )
+    ).one_or_none()
     return row.text if row else None
 
 
 @data_router.put("/text_content", response_model=bool)
-def put_or_update_text_content(
+async def put_or_update_text_content(
     text_content: TextContentItem,
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
+    admin: AdminPrincipal = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Add or update a taxonomy object in the database."""
     try:
-        obj = (
-            db.query(TextContentOrm)
-            .filter(cast(ColumnElement[bool], TextContentOrm.name == text_content.name))
-            .first()
+        obj = await db.scalar(
+            select(TextContentOrm).where(
+                cast(ColumnElement[bool], TextContentOrm.name == text_content.name)
+            )
         )
         if obj is not None:
             obj.text = text_content.text
             operation = "updated"
         else:
             operation = "created"
-            obj = TextContentOrm(**TextContentItem.dict())
+            obj = TextContentOrm(**text_content.dict())
 
-        db.merge(obj)
-        db.commit()  # Save changes to the database
+        await db.merge(obj)
+        await db.commit()  # Save changes to the database
 
         # Return appropriate response
         if operation == "created":
@@ -133,5 +138,5 @@ def put_or_update_text_content(
             return Response(status_code=status.HTTP_204_NO_CONTENT)
 
     except SQLAlchemyError as e:
-        db.rollback()  # Rollback in case of an error
+        await db.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,52 +1,126 @@
-import uuid
-from typing import Literal
+import asyncio
+import os
+import time
+from typing import Annotated, AsyncIterator, Literal, Optional
 
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    Header,
+    HTTPException,
+    Request,
+    Response,
+    status,
+)
+from fastapi_camelcase import CamelModel
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.responses import StreamingResponse
 
-from app import llm
+from app import llm, metrics
+from app.db.base import get_async_db
+from app.db.cache import taxonomy_cache
 from app.db.models import TaxonomyOrmItem
-from app.logger import create_logger
+from app.logger import create_logger, request_id
 from app.models.generationoptions import (
-    StandardGenerationOptions,
-    ModularGenerationOptions,
     AmpleGenerationOptions,
     GenerationOptions,
+    get_ui_level,
+    ui_level_models,
+)
+from app.models.metadata import metadata_cache
+from app.prompt import CompiledPrompt, fit_prompt
+from app.responsecache import replay, response_cache
+from app.scheduler import current_client, scheduler
+from app.sse import EventStreamResponse, coalescer
+from app.streams import (
+    StreamAdmissionError,
+    StreamRegistry,
+    TooManyStreamsError,
 )
-from app.models.metadata import create_metadata
-from app.prompt import build_prompt
-from app.routes.data import get_db, get_taxonomies
 
 logger = create_logger(__name__)
 
-generate_router = APIRouter(prefix="/generate")
+
+async def identify_client(
+    request: Request, x_session_id: Annotated[Optional[str], Header()] = None
+):
+    """Queue the LLM requests made for this request as those of its client.
+
+    Clients are told apart by the X-Session-Id header if they send one, and
+    otherwise by their address.
+    """
+    client = x_session_id or (request.client.host if request.client else None)
+    if client:
+        current_client.set(client)
+
+
+generate_router = APIRouter(prefix="/generate", dependencies=[Depends(identify_client)])
+
+
+async def taxonomies_info(db: AsyncSession) -> dict[str, TaxonomyOrmItem]:
+    start = time.perf_counter()
+    info = await taxonomy_cache.get(db)
+    metrics.taxonomy_fetch_seconds.observe(time.perf_counter() - start)
+    return info
 
 
-def taxonomies_info(db: Session = Depends(get_db)) -> dict[str, TaxonomyOrmItem]:
-    return {t.name: t for t in get_taxonomies(db)}
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
 
 
 @generate_router.get("/generation_options_metadata/{ui_level}")
 async def generation_options_metadata(
-    ui_level: Literal["Standard", "Modular", "Ample"], db: Session = Depends(get_db)
+    ui_level: Literal["Standard", "Modular", "Ample"],
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
 ):
-    if ui_level == "Standard":
-        return create_metadata(StandardGenerationOptions, db)
-    elif ui_level == "Modular":
-        return create_metadata(ModularGenerationOptions, db)
-    elif ui_level == "Ample":
-        return create_metadata(AmpleGenerationOptions, db)
+    document = await metadata_cache.get(ui_level_models[ui_level], db)
+    headers = {"ETag": document.etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), document.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(document.body, media_type="application/json", headers=headers)
+
+
+def _fit_prompt(
+    options: GenerationOptions, info: dict[str, TaxonomyOrmItem]
+) -> CompiledPrompt:
+    level = get_ui_level(options)
+    metrics.ui_level.set(level)
+    model = _extra_kwargs(options).get("model")
+    start = time.perf_counter()
+    prompt = fit_prompt(options, info, llm.clients.model(model))
+    metrics.prompt_build_seconds.observe(time.perf_counter() - start, ui_level=level)
+    return prompt
+
+
+def _report_prompt(prompt: CompiledPrompt, response: Response):
+    """Tell the client the size of the prompt and how much of it can be cached."""
+    logger.debug(
+        "Prompt of %d characters and %d tokens with a cacheable prefix of %d.",
+        len(prompt.text),
+        prompt.tokens,
+        prompt.prefix_length,
+    )
+    response.headers["X-Prompt-Tokens"] = str(prompt.tokens)
+    response.headers["X-Prompt-Prefix-Length"] = str(prompt.prefix_length)
+    if prompt.trimmed:
+        response.headers["X-Prompt-Trimmed-Taxonomies"] = str(len(prompt.trimmed))
 
 
 @generate_router.post("/create_prompt")
 async def create_prompt(
-    request: GenerationOptions,
-    db: Session = Depends(get_db),
+    request: Annotated[GenerationOptions, Body()],
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
 ):
     logger.debug(request)
-    prompt = build_prompt(request, taxonomies_info(db))
-    return prompt
+    prompt = _fit_prompt(request, await taxonomies_info(db))
+    _report_prompt(prompt, response)
+    return prompt.text
 
 
 def _extra_kwargs(generation_options: GenerationOptions):
@@ -59,39 +133,197 @@ def _extra_kwargs(generation_options: GenerationOptions):
 
 @generate_router.post("/generate_response")
 async def generate_outcomes(
-    request: GenerationOptions,
-    db: Session = Depends(get_db),
+    request: Annotated[GenerationOptions, Body()],
+    http_response: Response,
+    db: AsyncSession = Depends(get_async_db),
 ):
     logger.debug(request)
-    prompt = build_prompt(request, taxonomies_info(db))
+    compiled = _fit_prompt(request, await taxonomies_info(db))
+    _report_prompt(compiled, http_response)
+    prompt = compiled.text
     extra_kwargs = _extra_kwargs(request)
-    response = await llm.generate(prompt, **extra_kwargs)
+    key = response_cache.key(
+        prompt=prompt,
+        stream=False,
+        settings=llm.response_settings(extra_kwargs.get("model")),
+        **extra_kwargs,
+    )
+    response = await response_cache.get(key)
+    if response is None:
+        # the same shape whichever provider answered, so it can be cached
+        response = await llm.generate(prompt, **extra_kwargs)
+        await response_cache.put(key, response)
     return response
 
 
-_streaming_responses = dict()
+async def _produce_stream(request: dict) -> AsyncIterator[str]:
+    request = dict(request)
+    # the stream is produced by another HTTP request than the one that started it,
+    # whose UI level, client and id are kept for the metrics, the request queues
+    # and the logs of the stream
+    metrics.ui_level.set(request.pop("ui_level", ""))
+    client = request.pop("client", None)
+    if client is not None:
+        current_client.set(client)
+    started_by = request.pop("request_id", None)
+    if started_by is not None:
+        logger.debug("Producing the stream started by request %s.", started_by)
+        request_id.set(started_by)
+    key = response_cache.key(
+        stream=True, settings=llm.response_settings(request.get("model")), **request
+    )
+    cached = await response_cache.get(key)
+    if cached is not None:
+        return replay(cached)
+    return response_cache.record(key, await llm.generate(stream=True, **request))
+
+
+streams = StreamRegistry.from_env(_produce_stream, max_tokens=llm.max_tokens())
+
+
+def _admission_error(e: StreamAdmissionError) -> HTTPException:
+    return HTTPException(
+        status_code=(
+            status.HTTP_429_TOO_MANY_REQUESTS
+            if isinstance(e, TooManyStreamsError)
+            else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
 
 
 @generate_router.post("/start_stream")
 async def start_stream(
-    request: GenerationOptions,
-    db: Session = Depends(get_db),
+    request: Annotated[GenerationOptions, Body()],
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
 ):
     logger.debug(request)
-    prompt = build_prompt(request, taxonomies_info(db))
-    token = str(uuid.uuid4())
-    extra_kwargs = _extra_kwargs(request)
-    _streaming_responses[token] = llm.generate(prompt, stream=True, **extra_kwargs)
-    return {"token": token}
+    try:
+        await streams.admit()  # fail fast before building the prompt
+        prompt = _fit_prompt(request, await taxonomies_info(db))
+        _report_prompt(prompt, response)
+        extra_kwargs = _extra_kwargs(request)
+        token = await streams.register(
+            {
+                "prompt": prompt.text,
+                "ui_level": get_ui_level(request),
+                "client": current_client.get(),
+                "request_id": request_id.get(),
+                **extra_kwargs,
+            }
+        )
+    except StreamAdmissionError as e:
+        logger.warning("Rejected stream: %s (%s)", e, await streams.stats())
+        raise _admission_error(e)
+    # the requests served before this one if the stream were opened now
+    provider = llm.router.candidates(extra_kwargs.get("model"))[0]
+    position = scheduler.position(provider, current_client.get())
+    return {"token": token, "queuePosition": position}
 
 
 @generate_router.get("/stream_response/{token}")
-async def stream_response(token: str):
-    async def generator_function():
-        stream = _streaming_responses[token]
-        async for t in await stream:
-            yield f"data: {t}\n\n"
-        logger.debug("Removing stream with token '%s' from streaming responses.", token)
-        del _streaming_responses[token]
-
-    return StreamingResponse(generator_function(), media_type="text/event-stream")
+async def stream_response(
+    token: str, last_event_id: Annotated[Optional[str], Header()] = None
+):
+    # a reconnecting EventSource resumes after the last event it received
+    offset = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+    try:
+        stream = await streams.open(token, offset)
+    except KeyError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No stream with token '{token}'. It may have expired.",
+        )
+    except StreamAdmissionError as e:
+        logger.warning("Rejected stream: %s (%s)", e, await streams.stats())
+        raise _admission_error(e)
+
+    return EventStreamResponse(coalescer.events(stream, offset))
+
+
+class BatchItemResult(CamelModel):
+    index: int
+    status: Literal["ok", "error"]
+    response: Optional[str] = None
+    error: Optional[str] = None
+    prompt_ms: float
+    generation_ms: Optional[float] = None
+
+
+_batch_max_size = int(os.environ.get("BATCH_MAX_SIZE", 100))
+_batch_concurrency = int(os.environ.get("BATCH_CONCURRENCY", 4))
+
+
+@generate_router.post("/batch")
+async def generate_batch(
+    requests: list[GenerationOptions],
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Generate responses for many generation options in one call.
+
+    Results are streamed back as newline-delimited JSON in order of completion,
+    one BatchItemResult per request, identified by its index in the request list.
+    """
+    if len(requests) > _batch_max_size:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"A batch can hold at most {_batch_max_size} requests.",
+        )
+    logger.debug("Batch of %d generation requests.", len(requests))
+
+    info = await taxonomies_info(db)  # one snapshot for the whole batch
+    semaphore = asyncio.Semaphore(_batch_concurrency)
+
+    def failed(index: int, error: str, prompt_ms: float) -> BatchItemResult:
+        logger.warning("Batch item %d failed: %s", index, error)
+        return BatchItemResult(
+            index=index, status="error", error=error, prompt_ms=prompt_ms
+        )
+
+    async def run(index: int, options: GenerationOptions) -> BatchItemResult:
+        # the prompt is built per item, so an item whose prompt cannot be built
+        # fails on its own, e.g. for an unknown taxonomy
+        start = time.perf_counter()
+        try:
+            request = {
+                "prompt": _fit_prompt(options, info).text,
+                "ui_level": get_ui_level(options),
+                **_extra_kwargs(options),
+            }
+        except Exception as e:
+            return failed(
+                index,
+                f"Could not build the prompt: {e!r}",
+                (time.perf_counter() - start) * 1000,
+            )
+        prompt_ms = (time.perf_counter() - start) * 1000
+
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                chunks = [chunk async for chunk in await _produce_stream(request)]
+            except Exception as e:
+                return failed(index, str(e), prompt_ms)
+            return BatchItemResult(
+                index=index,
+                status="ok",
+                response="".join(chunks),
+                prompt_ms=prompt_ms,
+                generation_ms=(time.perf_counter() - start) * 1000,
+            )
+
+    async def results():
+        tasks = [
+            asyncio.create_task(run(index, options))
+            for index, options in enumerate(requests)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield (await task).model_dump_json(by_alias=True) + "\n"
+        finally:
+            for task in tasks:  # the client may have gone away
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
@@ -0,0 +1,113 @@
+from fastapi import APIRouter, Response
+
+from app import llm
+from app.db.cache import taxonomy_cache
+from app.metrics import CONTENT_TYPE, registry
+from app.responsecache import response_cache
+from app.routes.auth import principal_cache
+from app.routes.generate import streams
+from app.scheduler import scheduler
+
+metrics_router = APIRouter()
+
+streams_active = registry.gauge("streams_active", "Streams being generated.")
+streams_pending = registry.gauge(
+    "streams_pending", "Streams registered but not opened."
+)
+streams_abandoned = registry.counter(
+    "streams_abandoned_total", "Streams cancelled because every client went away."
+)
+streams_tokens_saved = registry.counter(
+    "streams_tokens_saved_total",
+    "Tokens at most not generated for abandoned streams: the response limit "
+    "less the tokens produced.",
+)
+scheduler_active = registry.gauge(
+    "llm_requests_active", "Requests sent to the provider.", ("provider",)
+)
+scheduler_waiting = registry.gauge(
+    "llm_requests_waiting", "Requests queued for the provider.", ("provider",)
+)
+scheduler_limit = registry.gauge(
+    "llm_requests_limit",
+    "Requests sent to the provider at once, 0 if unlimited.",
+    ("provider",),
+)
+provider_requests = registry.counter(
+    "llm_provider_requests_total", "Attempts sent to the provider.", ("provider",)
+)
+provider_failures = registry.counter(
+    "llm_provider_failures_total",
+    "Attempts to the provider that failed.",
+    ("provider",),
+)
+provider_latency = registry.gauge(
+    "llm_provider_latency_seconds",
+    "Moving average of the time to the first chunk or response.",
+    ("provider",),
+)
+router_retries = registry.counter("llm_retries_total", "Attempts that were retried.")
+router_hedges = registry.counter("llm_hedges_total", "Attempts that were hedged.")
+single_flight = registry.counter(
+    "llm_single_flight_total",
+    "Generation requests by whether they were sent upstream or joined another.",
+    ("outcome",),
+)
+usage_tokens = registry.counter(
+    "llm_usage_prompt_tokens_total",
+    "Prompt tokens reported by the providers, by whether they were cached.",
+    ("cached",),
+)
+cache_entries = registry.gauge(
+    "response_cache_entries", "Responses in the response cache."
+)
+cache_bytes = registry.gauge(
+    "response_cache_bytes", "Size of the responses in the response cache."
+)
+cache_lookups = registry.counter(
+    "cache_lookups_total", "Lookups in the caches by result.", ("cache", "result")
+)
+
+
+@registry.collector
+async def _collect():
+    stream_stats = await streams.stats()
+    streams_active.set(stream_stats["active"])
+    streams_pending.set(stream_stats["pending"])
+    streams_abandoned.set(stream_stats["abandoned"])
+    streams_tokens_saved.set(stream_stats["tokens_saved"])
+
+    for provider, stats in scheduler.stats().items():
+        scheduler_active.set(stats["active"], provider=provider)
+        scheduler_waiting.set(stats["waiting"], provider=provider)
+        scheduler_limit.set(stats["limit"], provider=provider)
+
+    for provider, stats in llm.router.report().items():
+        provider_requests.set(stats["requests"], provider=provider)
+        provider_failures.set(stats["failures"], provider=provider)
+        if stats["latency"] is not None:
+            provider_latency.set(stats["latency"], provider=provider)
+    router_retries.set(llm.router.retried)
+    router_hedges.set(llm.router.hedged)
+
+    for outcome, count in llm.single_flight_stats.items():
+        single_flight.set(count, outcome=outcome)
+    usage = llm.usage_stats
+    usage_tokens.set(usage["cached_tokens"], cached="true")
+    usage_tokens.set(usage["prompt_tokens"] - usage["cached_tokens"], cached="false")
+
+    response_stats = response_cache.stats()
+    cache_entries.set(response_stats["entries"])
+    cache_bytes.set(response_stats["bytes"])
+    for name, stats in (
+        ("response", response_stats),
+        ("taxonomy", taxonomy_cache.stats()),
+        ("principal", principal_cache.stats()),
+    ):
+        cache_lookups.set(stats["hits"], cache=name, result="hit")
+        cache_lookups.set(stats["misses"], cache=name, result="miss")
+
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(await registry.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+
+from app import metrics
+from app.logger import create_logger
+
+logger = create_logger(__name__)
+
+# the client on whose behalf the current request is made, set by the routes
+current_client: ContextVar[str] = ContextVar("current_client", default="anonymous")
+
+_default_limits = {"ollama": 4, "openai": 32}
+
+
+class _WaitStats:
+    def __init__(self):
+        self.requests = 0
+        self.queued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def observe(self, wait: float):
+        self.requests += 1
+        if wait > 0:
+            self.queued += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+
+class _Provider:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        # waiting requests per client, in the order the clients are served
+        self.queues: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+        self.stats = _WaitStats()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def has_capacity(self) -> bool:
+        return self.limit <= 0 or self.active < self.limit
+
+
+class FairScheduler:
+    """Limits the concurrent requests to each provider and queues the rest fairly.
+
+    Waiting requests are queued per client and the clients take turns, so a
+    client sending many requests cannot hold back the others. The limit of a
+    provider is set by LLM_MAX_CONCURRENCY_<PROVIDER>, e.g.
+    LLM_MAX_CONCURRENCY_OLLAMA; 0 means no limit.
+    """
+
+    def __init__(self, limits: dict[str, int]):
+        self.limits = limits
+        self._providers: dict[str, _Provider] = {}
+
+    @classmethod
+    def from_env(cls) -> "FairScheduler":
+        return cls(
+            {
+                provider: int(
+                    os.environ.get(f"LLM_MAX_CONCURRENCY_{provider.upper()}", default)
+                )
+                for provider, default in _default_limits.items()
+            }
+        )
+
+    def _provider(self, provider: str) -> _Provider:
+        if provider not in self._providers:
+            self._providers[provider] = _Provider(self.limits.get(provider, 0))
+        return self._providers[provider]
+
+    def waiting(self, provider: str) -> int:
+        """The number of requests queued for the provider."""
+        return self._provider(provider).waiting
+
+    def position(self, provider: str, client: str) -> int:
+        """The number of requests that would be served before a new request of the
+        client, 0 if it would be sent at once."""
+        state = self._provider(provider)
+        if state.has_capacity() and not state.queues:
+            return 0
+        own = len(state.queues.get(client, ()))
+        # every other client gets a turn for each request of the client ahead
+        return own + sum(
+            min(len(queue), own + 1)
+            for other, queue in state.queues.items()
+            if other != client
+        )
+
+    async def acquire(self, provider: str):
+        """Wait for a free slot with the provider; call release() when done."""
+        state = self._provider(provider)
+        start = time.monotonic()
+        if state.has_capacity() and not state.queues:
+            state.active += 1
+            state.stats.observe(0.0)
+            metrics.queue_wait_seconds.observe(0.0, provider=provider)
+            return
+
+        client = current_client.get()
+        waiter = asyncio.get_running_loop().create_future()
+        state.queues.setdefault(client, deque()).append(waiter)
+        logger.debug(
+            "Queued request of %s for %s (%d waiting).", client, provider, state.waiting
+        )
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(provider)  # granted just before being cancelled
+            else:
+                self._remove(state, client, waiter)
+            raise
+        wait = time.monotonic() - start
+        state.stats.observe(wait)
+        metrics.queue_wait_seconds.observe(wait, provider=provider)
+        logger.debug("Request of %s waited %.3f s for %s.", client, wait, provider)
+
+    @staticmethod
+    def _remove(state: _Provider, client: str, waiter: asyncio.Future):
+        queue = state.queues.get(client)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del state.queues[client]
+
+    def release(self, provider: str):
+        state = self._provider(provider)
+        state.active -= 1
+        while state.queues and state.has_capacity():
+            # the next client in turn goes to the back of the line
+            client, queue = state.queues.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                state.queues[client] = queue
+            if not waiter.done():
+                state.active += 1
+                waiter.set_result(None)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        return {
+            provider: {
+                "limit": state.limit,
+                "active": state.active,
+                "waiting": state.waiting,
+                "requests": state.stats.requests,
+                "queued": state.stats.queued,
+                "total_wait": state.stats.total_wait,
+                "max_wait": state.stats.max_wait,
+            }
+            for provider, state in self._providers.items()
+        }
+
+
+scheduler = FairScheduler.from_env()
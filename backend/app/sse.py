@@ -0,0 +1,167 @@
+import asyncio
+import os
+import re
+from typing import AsyncIterator, Optional
+
+import anyio
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+_line_break = re.compile(r"\r\n|\r|\n")
+
+HEARTBEAT = b": heartbeat\n\n"
+
+
+def _float_env(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def frame(data: str, event_id: Optional[int] = None) -> bytes:
+    """Frame data as one server-sent event.
+
+    Every line of data gets its own data field, which the client joins with
+    newlines again, so the data does not need to be escaped.
+    """
+    lines = _line_break.split(data)
+    parts = [f"id: {event_id}\n"] if event_id is not None else []
+    parts.extend(f"data: {line}\n" for line in lines)
+    parts.append("\n")
+    return "".join(parts).encode("utf-8")
+
+
+class Coalescer:
+    """Groups the chunks of a stream into server-sent events.
+
+    Chunks are buffered until max_bytes of text (counted in characters) have
+    been collected or max_delay seconds have passed since the first of them
+    arrived, whichever comes first, and then sent as one event. A max_delay of
+    0 sends chunks as soon as they arrive. When nothing has been sent for
+    heartbeat seconds, a comment is sent to keep proxies from closing the
+    connection.
+
+    Event ids count the chunks sent so far, so a client can resume with
+    Last-Event-ID from the offset it was given.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 1024,
+        max_delay: float = 0.05,
+        heartbeat: float = 15.0,
+    ):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.heartbeat = heartbeat
+
+    @classmethod
+    def from_env(cls) -> "Coalescer":
+        return cls(
+            max_bytes=int(os.environ.get("SSE_FLUSH_BYTES", 1024)),
+            max_delay=_float_env("SSE_FLUSH_INTERVAL", 0.05),
+            heartbeat=_float_env("SSE_HEARTBEAT", 15.0),
+        )
+
+    async def events(
+        self, stream: AsyncIterator[str], offset: int = 0
+    ) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+        buffer: list[str] = []
+        size = 0
+        done = False
+        error: Optional[Exception] = None
+        # the buffer should be sent, because it is full or max_delay has passed
+        due = False
+        heartbeat_due = False
+        wake = asyncio.Event()
+        flush_timer: Optional[asyncio.TimerHandle] = None
+
+        def flush_soon():
+            nonlocal due
+            due = True
+            wake.set()
+
+        def beat():
+            nonlocal heartbeat_due, heartbeat_timer
+            heartbeat_due = True
+            wake.set()
+            heartbeat_timer = loop.call_later(self.heartbeat, beat)
+
+        async def read():
+            nonlocal size, done, error, flush_timer
+            try:
+                async for chunk in stream:
+                    buffer.append(chunk)
+                    size += len(chunk)
+                    if size >= self.max_bytes or self.max_delay <= 0:
+                        flush_soon()
+                    elif len(buffer) == 1:
+                        flush_timer = loop.call_later(self.max_delay, flush_soon)
+            except Exception as e:
+                error = e
+            finally:
+                done = True
+                wake.set()
+
+        # the stream is read by its own task, so the timers only ever wake the
+        # writer and never interrupt the stream itself
+        reader = asyncio.create_task(read())
+        # one repeating timer per stream rather than one per wait
+        heartbeat_timer = loop.call_later(self.heartbeat, beat)
+        sent = False
+        event_id = offset
+        try:
+            while True:
+                if not (due or done or heartbeat_due):
+                    wake.clear()
+                    await wake.wait()
+                if heartbeat_due:
+                    heartbeat_due = False
+                    if not sent:
+                        yield HEARTBEAT
+                    sent = False
+                if buffer and (due or done):
+                    due = False
+                    if flush_timer is not None:
+                        flush_timer.cancel()
+                        flush_timer = None
+                    event_id += len(buffer)
+                    data = "".join(buffer)
+                    buffer.clear()
+                    size = 0
+                    sent = True
+                    # an event without data is ignored by clients
+                    yield frame(data, event_id) if data else HEARTBEAT
+                elif done:
+                    break
+            if error is not None:
+                raise error
+        finally:
+            heartbeat_timer.cancel()
+            if flush_timer is not None:
+                flush_timer.cancel()
+            reader.cancel()
+            try:
+                await reader
+            except asyncio.CancelledError:
+                pass
+
+
+class EventStreamResponse(StreamingResponse):
+    """A response of server-sent events that always closes its event iterator.
+
+    When the client disconnects, the response is cancelled and the iterator is
+    closed at once rather than when it is garbage collected, so whatever
+    produces the events is cancelled as well.
+    """
+
+    media_type = "text/event-stream"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+
+
+coalescer = Coalescer.from_env()
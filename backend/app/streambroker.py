@@ -0,0 +1,402 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+import anyio
+
+
+class StreamFailedError(Exception):
+    """The stream ended before it was finished, e.g. because producing it failed."""
+
+
+class StreamBroker(ABC):
+    """Shares streams between the worker that produces them and the workers serving them.
+
+    A stream is created with the request needed to produce it. The first caller to
+    claim the stream gets the request and publishes the chunks it produces; any
+    caller, in any worker for shared backends, can subscribe to replay the chunks
+    published so far and follow the stream until it is finished.
+    """
+
+    @abstractmethod
+    async def create(self, token: str, request: dict) -> None: ...
+
+    @abstractmethod
+    async def claim(self, token: str) -> Optional[dict]:
+        """Return the request if the caller is the first to claim the stream, and
+        None if it is already claimed. Raise KeyError if the token is unknown."""
+
+    @abstractmethod
+    async def claimed(self, token: str) -> bool:
+        """Whether the stream is claimed. Raise KeyError if the token is unknown."""
+
+    @abstractmethod
+    async def publish(self, token: str, chunk: str) -> bool:
+        """Append a chunk to the stream. Return False, and drop the chunk, if the
+        stream no longer exists, e.g. because it was evicted while produced."""
+
+    @abstractmethod
+    async def finish(self, token: str) -> None: ...
+
+    @abstractmethod
+    async def fail(self, token: str, error: str) -> None:
+        """End a stream that cannot be finished; subscribers raise StreamFailedError."""
+
+    @abstractmethod
+    async def discard(self, token: str) -> None:
+        """Remove a stream at once, e.g. when its client has gone away.
+        Subscribers of an unfinished stream raise StreamFailedError."""
+
+    @abstractmethod
+    def subscribe(self, token: str, offset: int = 0) -> AsyncIterator[str]:
+        """Iterate the chunks of a claimed stream from the given offset until it is
+        finished. Raise KeyError if the token is unknown, and StreamFailedError if
+        the stream fails or is removed before it is finished."""
+
+    @abstractmethod
+    async def subscribers(self, token: str) -> int:
+        """The number of callers following the stream through subscribe()."""
+
+    @abstractmethod
+    async def pending(self) -> int:
+        """The number of streams that have not been claimed yet."""
+
+    @abstractmethod
+    async def evict(
+        self, unclaimed_before: float, finished_before: float, created_before: float
+    ) -> int:
+        """Remove streams unclaimed since, finished before or created before the
+        given UNIX timestamps. Return the number of removed streams."""
+
+
+@dataclass
+class _Channel:
+    request: dict
+    created: float
+    claimed: bool = False
+    finished: Optional[float] = None
+    error: Optional[str] = None
+    subscribers: int = 0
+    chunks: list[str] = field(default_factory=list)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def remove(self):
+        if self.finished is None:
+            self.error = "The stream was removed before it was finished."
+            self.finished = time.time()
+        self.notify()  # wake up any subscriber so it can return
+
+
+class InMemoryStreamBroker(StreamBroker):
+    """Keeps streams in process memory. Only usable with a single worker."""
+
+    def __init__(self):
+        self._channels: dict[str, _Channel] = {}
+
+    async def create(self, token: str, request: dict) -> None:
+        self._channels[token] = _Channel(request, time.time())
+
+    async def claim(self, token: str) -> Optional[dict]:
+        channel = self._channels[token]
+        if channel.claimed:
+            return None
+        channel.claimed = True
+        return channel.request
+
+    async def claimed(self, token: str) -> bool:
+        return self._channels[token].claimed
+
+    async def publish(self, token: str, chunk: str) -> bool:
+        channel = self._channels.get(token)
+        if channel is None:
+            return False
+        channel.chunks.append(chunk)
+        channel.notify()
+        return True
+
+    async def finish(self, token: str) -> None:
+        channel = self._channels.get(token)
+        if channel is not None:
+            channel.finished = time.time()
+            channel.notify()
+
+    async def fail(self, token: str, error: str) -> None:
+        channel = self._channels.get(token)
+        if channel is not None:
+            channel.error = error
+            channel.finished = time.time()
+            channel.notify()
+
+    async def discard(self, token: str) -> None:
+        channel = self._channels.pop(token, None)
+        if channel is not None:
+            channel.remove()
+
+    async def subscribe(self, token: str, offset: int = 0) -> AsyncIterator[str]:
+        channel = self._channels[token]
+        channel.subscribers += 1
+        try:
+            while True:
+                changed = channel.changed
+                while offset < len(channel.chunks):
+                    yield channel.chunks[offset]
+                    offset += 1
+                if channel.error is not None:
+                    raise StreamFailedError(channel.error)
+                if channel.finished is not None:
+                    return
+                await changed.wait()
+        finally:
+            channel.subscribers -= 1
+
+    async def subscribers(self, token: str) -> int:
+        channel = self._channels.get(token)
+        return channel.subscribers if channel is not None else 0
+
+    async def pending(self) -> int:
+        return sum(1 for channel in self._channels.values() if not channel.claimed)
+
+    async def evict(
+        self, unclaimed_before: float, finished_before: float, created_before: float
+    ) -> int:
+        expired = [
+            token
+            for token, channel in self._channels.items()
+            if (not channel.claimed and channel.created < unclaimed_before)
+            or (channel.finished is not None and channel.finished < finished_before)
+            or channel.created < created_before
+        ]
+        for token in expired:
+            self._channels.pop(token).remove()
+        return len(expired)
+
+
+class SqliteStreamBroker(StreamBroker):
+    """Keeps streams in an SQLite file shared by all workers on the host.
+
+    Subscribers poll for new chunks, so chunks reach a subscriber in another
+    worker with a delay of up to poll_interval seconds.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.05):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._sequence: dict[str, int] = {}  # next chunk index of streams produced here
+        with self._connection() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS streams (
+                    token TEXT PRIMARY KEY,
+                    request TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    claimed INTEGER NOT NULL DEFAULT 0,
+                    finished REAL,
+                    error TEXT,
+                    subscribers INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS chunks (
+                    token TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (token, seq)
+                );
+                """
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        with self._connection() as connection:  # commits or rolls back
+            return connection.execute(sql, parameters).fetchall()
+
+    async def create(self, token: str, request: dict) -> None:
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO streams (token, request, created) VALUES (?, ?, ?)",
+            (token, json.dumps(request), time.time()),
+        )
+
+    def _claim(self, token: str) -> Optional[dict]:
+        with self._connection() as connection:
+            row = connection.execute(
+                "UPDATE streams SET claimed = 1 WHERE token = ? AND claimed = 0 "
+                "RETURNING request",
+                (token,),
+            ).fetchone()
+            if row is not None:
+                return json.loads(row[0])
+            if connection.execute(
+                "SELECT 1 FROM streams WHERE token = ?", (token,)
+            ).fetchone():
+                return None
+        raise KeyError(token)
+
+    async def claim(self, token: str) -> Optional[dict]:
+        request = await asyncio.to_thread(self._claim, token)
+        if request is not None:
+            self._sequence[token] = 0
+        return request
+
+    async def claimed(self, token: str) -> bool:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT claimed FROM streams WHERE token = ?", (token,)
+        )
+        if not rows:
+            raise KeyError(token)
+        return bool(rows[0][0])
+
+    def _publish(self, token: str, seq: int, chunk: str) -> bool:
+        with self._connection() as connection:
+            # nothing is inserted for a removed stream, which would leave orphans
+            return (
+                connection.execute(
+                    "INSERT INTO chunks (token, seq, data) SELECT ?, ?, ? "
+                    "WHERE EXISTS (SELECT 1 FROM streams WHERE token = ?)",
+                    (token, seq, chunk, token),
+                ).rowcount
+                > 0
+            )
+
+    async def publish(self, token: str, chunk: str) -> bool:
+        seq = self._sequence.get(token)
+        if seq is None:
+            return False
+        self._sequence[token] = seq + 1
+        published = await asyncio.to_thread(self._publish, token, seq, chunk)
+        if not published:
+            self._sequence.pop(token, None)
+        return published
+
+    async def finish(self, token: str) -> None:
+        self._sequence.pop(token, None)
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE streams SET finished = ? WHERE token = ?",
+            (time.time(), token),
+        )
+
+    async def fail(self, token: str, error: str) -> None:
+        self._sequence.pop(token, None)
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE streams SET finished = ?, error = ? WHERE token = ?",
+            (time.time(), error, token),
+        )
+
+    def _discard(self, token: str):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM streams WHERE token = ?", (token,))
+            connection.execute("DELETE FROM chunks WHERE token = ?", (token,))
+
+    async def discard(self, token: str) -> None:
+        self._sequence.pop(token, None)
+        await asyncio.to_thread(self._discard, token)
+
+    def _read(self, token: str, offset: int) -> tuple[list[str], bool, Optional[str]]:
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT finished, error FROM streams WHERE token = ?", (token,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(token)
+            # read after the finished flag, so no chunks can be missed
+            chunks = connection.execute(
+                "SELECT data FROM chunks WHERE token = ? AND seq >= ? ORDER BY seq",
+                (token, offset),
+            ).fetchall()
+        return [data for (data,) in chunks], row[0] is not None, row[1]
+
+    def _subscribe(self, token: str, change: int):
+        self._execute(
+            "UPDATE streams SET subscribers = subscribers + ? WHERE token = ?",
+            (change, token),
+        )
+
+    async def subscribe(self, token: str, offset: int = 0) -> AsyncIterator[str]:
+        chunks, finished, error = await asyncio.to_thread(self._read, token, offset)
+        await asyncio.to_thread(self._subscribe, token, 1)
+        try:
+            while True:
+                for chunk in chunks:
+                    yield chunk
+                offset += len(chunks)
+                if error is not None:
+                    raise StreamFailedError(error)
+                if finished:
+                    return
+                if not chunks:
+                    await asyncio.sleep(self.poll_interval)
+                try:
+                    chunks, finished, error = await asyncio.to_thread(
+                        self._read, token, offset
+                    )
+                except KeyError:
+                    raise StreamFailedError(
+                        "The stream was removed before it was finished."
+                    )
+        finally:
+            with anyio.CancelScope(shield=True):
+                await asyncio.to_thread(self._subscribe, token, -1)
+
+    async def subscribers(self, token: str) -> int:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT subscribers FROM streams WHERE token = ?", (token,)
+        )
+        return rows[0][0] if rows else 0
+
+    async def pending(self) -> int:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT COUNT(*) FROM streams WHERE claimed = 0"
+        )
+        return rows[0][0]
+
+    def _evict(
+        self, unclaimed_before: float, finished_before: float, created_before: float
+    ) -> int:
+        with self._connection() as connection:
+            count = connection.execute(
+                "DELETE FROM streams WHERE (claimed = 0 AND created < ?) "
+                "OR finished < ? OR created < ?",
+                (unclaimed_before, finished_before, created_before),
+            ).rowcount
+            if count:
+                connection.execute(
+                    "DELETE FROM chunks WHERE token NOT IN (SELECT token FROM streams)"
+                )
+        return count
+
+    async def evict(
+        self, unclaimed_before: float, finished_before: float, created_before: float
+    ) -> int:
+        return await asyncio.to_thread(
+            self._evict, unclaimed_before, finished_before, created_before
+        )
+
+
+def broker_from_env() -> StreamBroker:
+    """Create the broker set by STREAM_BROKER, either 'memory' or 'sqlite:///<path>'."""
+    setting = os.environ.get("STREAM_BROKER", "memory")
+    if setting == "memory":
+        return InMemoryStreamBroker()
+    elif setting.startswith("sqlite:///"):
+        return SqliteStreamBroker(setting.removeprefix("sqlite:///"))
+    raise ValueError(f"Unsupported STREAM_BROKER setting: '{setting}'")
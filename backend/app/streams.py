@@ -0,0 +1,268 @@
+import asyncio
+import os
+import time
+import uuid
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import anyio
+
+from app.logger import create_logger
+from app.streambroker import StreamBroker, StreamFailedError, broker_from_env
+
+logger = create_logger(__name__)
+
+Producer = Callable[[dict], Awaitable[AsyncIterator[str]]]
+
+
+class StreamAdmissionError(Exception):
+    """Raised when a new stream cannot be admitted. Retry after the given seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TooManyStreamsError(StreamAdmissionError):
+    """The per-process limit of concurrently running streams is reached."""
+
+
+class StreamRegistryFullError(StreamAdmissionError):
+    """The registry holds the maximum number of unclaimed streams."""
+
+
+class _Production:
+    """A stream produced by this process for the client that opened it.
+
+    The upstream iterator is pumped by a task of its own, so that the stream can
+    be finished for the other subscribers when that client goes away.
+    """
+
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def follow(self) -> AsyncIterator[str]:
+        offset = 0
+        while True:
+            changed = self.changed
+            while offset < len(self.chunks):
+                yield self.chunks[offset]
+                offset += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class StreamRegistry:
+    """Holds requested streams until their token is opened by a client.
+
+    Registering a stream only stores the request in the broker. The first client
+    to open the token produces the stream and publishes it to the broker while
+    receiving it; later clients replay and follow it through the broker.
+
+    The registry is bounded in two ways: at most max_pending streams can wait to
+    be opened, and unopened streams are evicted after ttl seconds; and at most
+    max_active streams can be produced by this process at the same time.
+    Finished streams can be replayed for ttl seconds.
+
+    A stream is abandoned when the client producing it goes away before it is
+    finished and no other client follows it. The upstream request is then
+    cancelled and the stream discarded. The tokens that were not generated are
+    counted as at most the response limit, max_tokens, less those produced. If other
+    clients follow it, the stream is finished for them instead. A stream whose
+    production fails is marked as failed, so that its subscribers fail too rather
+    than end as if it were complete.
+    """
+
+    def __init__(
+        self,
+        broker: StreamBroker,
+        produce: Producer,
+        max_pending: int = 256,
+        ttl: float = 60.0,
+        max_active: int = 64,
+        retry_after: int = 5,
+        max_lifetime: float = 3600.0,
+        max_tokens: int = 2000,
+    ):
+        self.broker = broker
+        self.produce = produce
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.max_active = max_active
+        self.retry_after = retry_after
+        self.max_lifetime = max_lifetime
+        self.max_tokens = max_tokens
+        self.active = 0
+        self.evicted = 0
+        self.abandoned = 0
+        self.tokens_saved = 0
+        self._last_eviction = 0.0
+        # strong references to the tasks producing streams, by token
+        self._productions: dict[str, _Production] = {}
+
+    @classmethod
+    def from_env(cls, produce: Producer, max_tokens: int = 2000) -> "StreamRegistry":
+        return cls(
+            broker_from_env(),
+            produce,
+            max_pending=int(os.environ.get("STREAM_MAX_PENDING", 256)),
+            ttl=float(os.environ.get("STREAM_TTL", 60.0)),
+            max_active=int(os.environ.get("STREAM_MAX_ACTIVE", 64)),
+            retry_after=int(os.environ.get("STREAM_RETRY_AFTER", 5)),
+            max_lifetime=float(os.environ.get("STREAM_MAX_LIFETIME", 3600.0)),
+            max_tokens=max_tokens,
+        )
+
+    async def evict_expired(self):
+        now = time.time()
+        if now - self._last_eviction < 1.0:
+            return  # at most once per second; the broker may be shared
+        self._last_eviction = now
+        evicted = await self.broker.evict(
+            unclaimed_before=now - self.ttl,
+            finished_before=now - self.ttl,
+            created_before=now - self.max_lifetime,
+        )
+        if evicted:
+            self.evicted += evicted
+            logger.debug("Evicted %d expired streams.", evicted)
+
+    async def admit(self):
+        """Raise a StreamAdmissionError if a new stream cannot be registered now."""
+        await self.evict_expired()
+        if self.active >= self.max_active:
+            raise TooManyStreamsError(
+                "Too many streams are being generated. Try again shortly.",
+                retry_after=self.retry_after,
+            )
+        if await self.broker.pending() >= self.max_pending:
+            raise StreamRegistryFullError(
+                "The service is saturated. Try again shortly.",
+                retry_after=self.retry_after,
+            )
+
+    async def register(self, request: dict) -> str:
+        """Store the request of a stream and return the token to open it with."""
+        await self.admit()
+        token = str(uuid.uuid4())
+        await self.broker.create(token, request)
+        return token
+
+    async def open(self, token: str, offset: int = 0) -> AsyncIterator[str]:
+        """Return an iterator over the stream, starting at the given chunk offset.
+
+        Raises KeyError if the token is unknown or has expired, and
+        TooManyStreamsError if the stream would have to be produced while
+        max_active streams already are.
+        """
+        await self.evict_expired()
+        if self.active >= self.max_active:
+            # a stream produced elsewhere can still be followed
+            if not await self.broker.claimed(token):
+                raise TooManyStreamsError(
+                    "Too many streams are being generated. Try again shortly.",
+                    retry_after=self.retry_after,
+                )
+            return self.broker.subscribe(token, offset)
+        # the slot is taken before claiming, so that concurrent opens cannot exceed
+        # max_active; it is given back when the production ends
+        self.active += 1
+        try:
+            request = await self.broker.claim(token)
+        except BaseException:
+            self.active -= 1
+            raise
+        if request is None:
+            self.active -= 1
+            return self.broker.subscribe(token, offset)
+        return self._produce(token, request)
+
+    def _abandon(self, token: str, produced: int):
+        self.abandoned += 1
+        # a chunk is about one token for the supported providers
+        saved = max(self.max_tokens - produced, 0)
+        self.tokens_saved += saved
+        logger.info(
+            "Stream with token '%s' abandoned after %d chunks, "
+            "at most %d tokens saved.",
+            token,
+            produced,
+            saved,
+        )
+
+    async def _pump(self, token: str, request: dict, production: _Production):
+        try:
+            # closing the upstream iterator cancels the request to the provider
+            async with aclosing(await self.produce(request)) as chunks:
+                async for chunk in chunks:
+                    if not await self.broker.publish(token, chunk):
+                        # removed by the broker, e.g. after max_lifetime
+                        raise StreamFailedError(
+                            f"Stream with token '{token}' expired after "
+                            f"{len(production.chunks)} chunks."
+                        )
+                    production.chunks.append(chunk)
+                    production.notify()
+            await self.broker.finish(token)
+            logger.debug("Stream with token '%s' finished.", token)
+        except asyncio.CancelledError:
+            with anyio.CancelScope(shield=True):
+                self._abandon(token, len(production.chunks))
+                await self.broker.discard(token)
+            raise
+        except Exception as e:
+            production.error = e
+            logger.warning("Stream with token '%s' failed: %r", token, e)
+            with anyio.CancelScope(shield=True):
+                await self.broker.fail(token, str(e) or repr(e))
+        finally:
+            self.active -= 1
+            self._productions.pop(token, None)
+            production.done = True
+            production.notify()
+
+    def _produce(self, token: str, request: dict) -> AsyncIterator[str]:
+        # started at once, so that the slot is given back even if the client never
+        # iterates the stream
+        production = _Production()
+        self._productions[token] = production
+        production.task = asyncio.create_task(self._pump(token, request, production))
+        return self._follow(token, production)
+
+    async def _follow(self, token: str, production: _Production) -> AsyncIterator[str]:
+        try:
+            async for chunk in production.follow():
+                yield chunk
+        finally:
+            if not production.done:
+                with anyio.CancelScope(shield=True):
+                    subscribers = await self.broker.subscribers(token)
+                if subscribers:
+                    logger.info(
+                        "Client of stream with token '%s' went away, "
+                        "finishing it for %d other subscribers.",
+                        token,
+                        subscribers,
+                    )
+                else:
+                    production.task.cancel()
+
+    async def stats(self) -> dict[str, int]:
+        return {
+            "pending": await self.broker.pending(),
+            "active": self.active,
+            "evicted": self.evicted,
+            "abandoned": self.abandoned,
+            "tokens_saved": self.tokens_saved,
+        }
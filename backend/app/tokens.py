@@ -0,0 +1,72 @@
+import functools
+import math
+import threading
+from typing import Optional
+
+from app.logger import create_logger
+
+logger = create_logger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # optional, token counts are estimated without it
+    tiktoken = None
+
+# characters per token used when no tokenizer is available; about right for
+# English text with the tokenizers of the supported models
+CHARACTERS_PER_TOKEN = 4
+
+# the encodings by name, None for one that could not be loaded; there are only a
+# few, whereas the model names come from the requests
+_encodings: dict[str, Optional["tiktoken.Encoding"]] = {}
+_loading: set[str] = set()
+_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=256)
+def _encoding_name(model: str) -> str:
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        # not an OpenAI model, e.g. llama3, whose tokenizer is close to cl100k
+        return "cl100k_base"
+
+
+def _load(name: str):
+    try:
+        encoding = tiktoken.get_encoding(name)
+    except Exception as e:  # the encoding is downloaded on first use
+        logger.warning("No tokenizer %s, estimating token counts: %s", name, e)
+        encoding = None
+    with _lock:
+        _encodings[name] = encoding
+        _loading.discard(name)
+
+
+def preload(model: str):
+    """Load the encoding of the model on a thread of its own.
+
+    Loading may download the encoding, which must not hold up the event loop;
+    token counts are estimated until it is loaded. The application preloads the
+    encodings of its default models on startup.
+    """
+    if tiktoken is None:
+        return
+    name = _encoding_name(model)
+    with _lock:
+        if name in _encodings or name in _loading:
+            return
+        _loading.add(name)
+    threading.Thread(
+        target=_load, args=(name,), name=f"tiktoken-{name}", daemon=True
+    ).start()
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Count the tokens of text for the model, or estimate them if its encoding
+    is not loaded (yet) or tiktoken is not installed."""
+    encoding = _encodings.get(_encoding_name(model)) if tiktoken else None
+    if encoding is None:
+        preload(model)
+        return math.ceil(len(text) / CHARACTERS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
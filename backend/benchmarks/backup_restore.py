@@ -0,0 +1,130 @@
+"""Benchmark of backing up and restoring a database of growing size.
+
+Fills a temporary SQLite database with synthetic taxonomies, parameters and text
+content, and reports the time and peak Python memory of JSON and SQLite
+backups, and the rows per second of restoring a backup with per-row ORM adds,
+as before, and with the batched inserts of overwrite_tables().
+
+Usage (from the backend directory):
+
+    python -m benchmarks.backup_restore [--rows N,N,...]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(_tmp.name) / 'benchmark.db'}"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from app.db import backup  # noqa: E402
+from app.db.base import Base, SessionLocal, engine  # noqa: E402
+from app.db.models import ParameterOrm, TaxonomyOrm, TextContentOrm  # noqa: E402
+
+
+def synthetic_backup(rows: int) -> dict[str, list[dict]]:
+    """About rows rows, a tenth of them taxonomies with eight parameters each."""
+    taxonomies = max(rows // 10, 1)
+    text = "A taxonomy of learning outcomes. " * 30
+    return {
+        "taxonomies": [
+            dict(
+                id=i,
+                name=f"Taxonomy {i}",
+                short_description=text[:200],
+                text=text,
+                ui_level="Ample",
+                priority=float(i),
+                step_type="LEVEL",
+            )
+            for i in range(taxonomies)
+        ],
+        "parameters": [
+            dict(
+                id=i,
+                name=f"Parameter {i}",
+                short_description=None,
+                disabled=False,
+                taxonomy_id=i // 8,
+            )
+            for i in range(taxonomies * 8)
+        ],
+        "text_content": [
+            dict(id=i, name=f"Text {i}", text=text) for i in range(taxonomies)
+        ],
+    }
+
+
+# the restore before rows were inserted in batches, kept as the baseline
+def legacy_overwrite_tables(backup_data: dict):
+    db = SessionLocal()
+    models = {m.__tablename__: m for m in (TaxonomyOrm, ParameterOrm, TextContentOrm)}
+    for table_name, records in backup_data.items():
+        model = models[table_name]
+        db.query(model).delete()
+        for record in records:
+            db.add(model(**record))
+    db.commit()
+    db.close()
+
+
+def measure(function) -> tuple[float, float]:
+    """The seconds and the peak MiB allocated by Python, each from a separate run,
+    as tracing the allocations slows the run down."""
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--rows",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=[1_000, 10_000, 100_000],
+    )
+    args = parser.parse_args()
+    Base.metadata.create_all(engine)
+
+    for rows in args.rows:
+        data = synthetic_backup(rows)
+        total = sum(len(records) for records in data.values())
+        print(f"{total} rows")
+
+        start = time.perf_counter()
+        legacy_overwrite_tables(data)
+        elapsed = time.perf_counter() - start
+        print(
+            f"  restore, per-row ORM adds: {elapsed:7.3f} s {total / elapsed:9.0f} rows/s"
+        )
+        start = time.perf_counter()
+        backup.overwrite_tables(data, SessionLocal())
+        elapsed = time.perf_counter() - start
+        print(
+            f"  restore, batched inserts:  {elapsed:7.3f} s {total / elapsed:9.0f} rows/s"
+        )
+
+        for backup_format in ("json", "sqlite"):
+            files = []
+            elapsed, peak = measure(
+                lambda: files.append(backup.create_backup("b", backup_format))
+            )
+            print(
+                f"  {backup_format} backup: {elapsed:7.3f} s, peak memory {peak:6.1f} MiB, "
+                f"{files[0].stat().st_size / 1024 / 1024:6.1f} MiB on disk"
+            )
+            for file in files:
+                file.unlink()
+
+
+if __name__ == "__main__":
+    main()
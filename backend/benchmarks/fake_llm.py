@@ -0,0 +1,132 @@
+"""A stand-in LLM server for benchmarks, speaking the Ollama and OpenAI APIs.
+
+Answers POST /api/generate like Ollama and POST /v1/chat/completions like
+OpenAI, streamed or not, with a fixed response of word tokens. The latency
+before the first token and the rate of tokens after it are configurable, so
+the backend can be load tested without a model or API key. GET /calls returns
+the number of generation requests served.
+
+Usage (from the backend directory):
+
+    python -m benchmarks.fake_llm [--port 11434] [--tokens N] [--rate TOKENS_PER_SECOND]
+        [--latency SECONDS]
+
+Point the backend at it with OLLAMA_HOST=http://localhost:11434, or with
+OPENAI_API_KEY=fake and OPENAI_BASE_URL=http://localhost:11434/v1.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+def create_app(tokens: int = 200, rate: float = 50.0, latency: float = 0.2):
+    calls = {"generate": 0}
+    words = [f"word{i}" + ("\n" if i % 10 == 9 else " ") for i in range(tokens)]
+    interval = 1 / rate if rate > 0 else 0
+
+    async def emit():
+        await asyncio.sleep(latency)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(interval)
+            yield word
+
+    async def ollama_generate(request: Request):
+        body = await request.json()
+        calls["generate"] += 1
+        done = {
+            "model": body["model"],
+            "response": "",
+            "done": True,
+            "prompt_eval_count": len(body["prompt"]) // 4,
+            "eval_count": tokens,
+        }
+        if not body.get("stream", True):
+            await asyncio.sleep(latency + interval * (tokens - 1))
+            return JSONResponse({**done, "response": "".join(words)})
+
+        async def chunks():
+            async for word in emit():
+                chunk = {"model": body["model"], "response": word, "done": False}
+                yield json.dumps(chunk) + "\n"
+            yield json.dumps(done) + "\n"
+
+        return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+    async def openai_chat_completions(request: Request):
+        body = await request.json()
+        calls["generate"] += 1
+        prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": tokens,
+            "total_tokens": prompt_tokens + tokens,
+        }
+        base = {"id": "fake", "created": int(time.time()), "model": body["model"]}
+        if not body.get("stream"):
+            await asyncio.sleep(latency + interval * (tokens - 1))
+            choice = {
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(words)},
+                "finish_reason": "stop",
+            }
+            return JSONResponse(
+                {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [choice],
+                    "usage": usage,
+                }
+            )
+
+        def event(choices: list, **fields) -> str:
+            chunk = {**base, "object": "chat.completion.chunk", "choices": choices}
+            return f"data: {json.dumps({**chunk, **fields})}\n\n"
+
+        async def events():
+            async for word in emit():
+                delta = {"content": word}
+                yield event([{"index": 0, "delta": delta, "finish_reason": None}])
+            yield event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield event([], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def get_calls(request: Request):
+        return JSONResponse(calls)
+
+    return Starlette(
+        routes=[
+            Route("/api/generate", ollama_generate, methods=["POST"]),
+            Route("/v1/chat/completions", openai_chat_completions, methods=["POST"]),
+            Route("/calls", get_calls),
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50.0, help="tokens per second")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds")
+    args = parser.parse_args()
+    uvicorn.run(
+        create_app(args.tokens, args.rate, args.latency),
+        port=args.port,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
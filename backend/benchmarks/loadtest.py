@@ -0,0 +1,298 @@
+"""Load test of the generation endpoints against a seeded database and a fake LLM.
+
+Seeds a new SQLite database from db-setup/seed_data.json, starts the fake LLM
+server of benchmarks.fake_llm and the backend with uvicorn, and drives these
+scenarios at increasing concurrency:
+
+    metadata   GET  /generate/generation_options_metadata/{ui_level}
+    prompt     POST /generate/create_prompt
+    response   POST /generate/generate_response
+    stream     POST /generate/start_stream, then GET /generate/stream_response
+
+For every scenario and concurrency it reports the latency percentiles, the time
+to the first streamed event (from start_stream), the throughput and the
+resident memory of the backend. Requests cycle through the UI levels and get
+a unique target name, so the response cache and single-flight do not serve
+them. Any other settings of the backend, e.g. LLM_MAX_CONCURRENCY_OLLAMA, are
+taken from the environment.
+
+Usage (from the backend directory):
+
+    python -m benchmarks.loadtest [--concurrency 1,4,16,64] [--requests N]
+        [--scenarios metadata,prompt,response,stream] [--provider ollama|openai]
+        [--tokens N] [--rate TOKENS_PER_SECOND] [--latency SECONDS]
+        [--output results.json]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+BACKEND = Path(__file__).parent.parent
+SEED_DATA = BACKEND / "db-setup" / "seed_data.json"
+UI_LEVELS = ("Standard", "Modular", "Ample")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def seed_database(url: str):
+    os.environ["DATABASE_URL"] = url
+    from app.db import models  # noqa: F401, registers the tables
+    from app.db.backup import overwrite_tables
+    from app.db.base import Base, SessionLocal, engine
+
+    Base.metadata.create_all(engine)
+    with open(SEED_DATA, "r") as f:
+        overwrite_tables(json.load(f), SessionLocal())
+    engine.dispose()
+
+
+def rss(pid: int) -> tuple[Optional[float], Optional[float]]:
+    """The current and peak resident memory of a process in MiB, on Linux."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return None, None
+    return tuple(int(fields[k].split()[0]) / 1024 for k in ("VmRSS", "VmHWM"))
+
+
+def percentile(values: list[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def default_value(metadata: dict):
+    """The default value of an option or group from the generation options metadata."""
+    kind = metadata["type"]
+    if kind == "optionGroup":
+        return {k: default_value(v) for k, v in metadata["group"].items()}
+    if kind == "toggledOptionGroup":
+        group = {k: default_value(v) for k, v in metadata["group"].items()}
+        group["enabled"] = metadata["default"]
+        group["priority"] = metadata.get("priority", 0)
+        return group
+    if kind == "toggledOptionGroupArray":
+        return {k: default_value(v) for k, v in metadata["groups"].items()}
+    if kind in ("string", "stringArray"):
+        return metadata.get("default") or ("" if kind == "string" else [])
+    return metadata.get("default")
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, options: dict[str, dict]):
+        self.client = client
+        self.options = options
+        self.counter = itertools.count()
+
+    def _request(self) -> tuple[str, dict]:
+        n = next(self.counter)
+        ui_level = UI_LEVELS[n % len(UI_LEVELS)]
+        options = json.loads(json.dumps(self.options[ui_level]))
+        options["educationInfo"]["targetName"] = f"Load test {n}"
+        return ui_level, options
+
+    async def metadata(self) -> Optional[float]:
+        ui_level, _ = self._request()
+        url = f"/generate/generation_options_metadata/{ui_level}"
+        (await self.client.get(url)).raise_for_status()
+
+    async def prompt(self) -> Optional[float]:
+        _, options = self._request()
+        url = "/generate/create_prompt"
+        (await self.client.post(url, json=options)).raise_for_status()
+
+    async def response(self) -> Optional[float]:
+        _, options = self._request()
+        url = "/generate/generate_response"
+        (await self.client.post(url, json=options)).raise_for_status()
+
+    async def stream(self) -> Optional[float]:
+        """Returns the seconds from start_stream to the first event with data."""
+        _, options = self._request()
+        start = time.perf_counter()
+        response = await self.client.post("/generate/start_stream", json=options)
+        response.raise_for_status()
+        url = f"/generate/stream_response/{response.json()['token']}"
+        first = None
+        async with self.client.stream("GET", url) as events:
+            events.raise_for_status()
+            async for line in events.aiter_lines():
+                if first is None and line.startswith("data:"):
+                    first = time.perf_counter() - start
+        return first
+
+    async def run(self, scenario: str, concurrency: int, requests: int) -> dict:
+        send = getattr(self, scenario)
+        latencies, first_events, errors = [], [], 0
+        remaining = iter(range(requests))
+
+        async def worker():
+            nonlocal errors
+            for _ in remaining:
+                start = time.perf_counter()
+                try:
+                    first = await send()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+                if first is not None:
+                    first_events.append(first)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        return {
+            "scenario": scenario,
+            "concurrency": concurrency,
+            "requests": requests,
+            "errors": errors,
+            "throughput": len(latencies) / elapsed,
+            **{f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+            **{f"ttft_p{p}": percentile(first_events, p) for p in (50, 95, 99)},
+        }
+
+
+def _ms(seconds: Optional[float]) -> str:
+    return f"{seconds * 1000:8.1f}" if seconds is not None else f"{'-':>8}"
+
+
+def report(result: dict):
+    memory = result["rss_mib"]
+    print(
+        f"{result['scenario']:>9} {result['concurrency']:>4} "
+        f"{result['throughput']:8.1f}/s {result['errors']:>4} err "
+        f"p50 {_ms(result['p50'])} p95 {_ms(result['p95'])} p99 {_ms(result['p99'])} "
+        f"ttft p50 {_ms(result['ttft_p50'])} p95 {_ms(result['ttft_p95'])} "
+        + (f"rss {memory:6.1f} MiB" if memory is not None else ""),
+        flush=True,
+    )
+
+
+async def load_test(args, base_url: str, pid: int) -> list[dict]:
+    results = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=300, limits=limits
+    ) as client:
+        options = {}
+        for ui_level in UI_LEVELS:
+            url = f"/generate/generation_options_metadata/{ui_level}"
+            metadata = (await client.get(url)).json()
+            options[ui_level] = {k: default_value(v) for k, v in metadata.items()}
+        test = LoadTest(client, options)
+
+        print("scenario, concurrency, throughput, errors, latencies in ms, memory")
+        for concurrency in args.concurrency:
+            for scenario in args.scenarios:
+                result = await test.run(scenario, concurrency, args.requests)
+                result["rss_mib"], result["peak_rss_mib"] = rss(pid)
+                report(result)
+                results.append(result)
+    return results
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise TimeoutError(f"{url} did not respond within {timeout} seconds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--concurrency",
+        type=lambda s: [int(c) for c in s.split(",")],
+        default=[1, 4, 16, 64],
+    )
+    parser.add_argument("--requests", type=int, default=64, help="per scenario")
+    parser.add_argument(
+        "--scenarios",
+        type=lambda s: s.split(","),
+        default=["metadata", "prompt", "response", "stream"],
+    )
+    parser.add_argument("--provider", choices=("ollama", "openai"), default="ollama")
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=200.0, help="tokens per second")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = f"sqlite:///{Path(tmp) / 'loadtest.db'}"
+        seed_database(database_url)
+
+        llm_port, app_port = free_port(), free_port()
+        llm_url = f"http://localhost:{llm_port}"
+        env = {
+            **os.environ,
+            "DATABASE_URL": database_url,
+            "ALLOWED_ORIGINS": os.environ.get("ALLOWED_ORIGINS", "http://localhost"),
+            "JWT_SECRET_KEY": os.environ.get("JWT_SECRET_KEY", "loadtest"),
+            "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+            "LLM_PROVIDERS": args.provider,
+        }
+        if args.provider == "openai":
+            env.update(OPENAI_API_KEY="fake", OPENAI_BASE_URL=f"{llm_url}/v1")
+        else:
+            env["OLLAMA_HOST"] = llm_url
+
+        fake_llm = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_llm", "--port", str(llm_port)]
+            + ["--tokens", str(args.tokens), "--rate", str(args.rate)]
+            + ["--latency", str(args.latency)],
+            cwd=BACKEND,
+        )
+        app = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(app_port)]
+            + ["--log-level", "warning", "--no-access-log"],
+            cwd=BACKEND,
+            env=env,
+        )
+        try:
+            wait_until_up(f"{llm_url}/calls", fake_llm)
+            base_url = f"http://localhost:{app_port}"
+            wait_until_up(f"{base_url}/metrics", app)
+            print(
+                f"{args.provider} stand-in: {args.tokens} tokens at {args.rate:g}/s "
+                f"after {args.latency:g} s, {args.requests} requests per scenario"
+            )
+            results = asyncio.run(load_test(args, base_url, app.pid))
+        finally:
+            for process in (app, fake_llm):
+                process.terminate()
+                process.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
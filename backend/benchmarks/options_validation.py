@@ -0,0 +1,157 @@
+"""Micro-benchmark of validating the generation options of a request.
+
+Compares validating the options as before, against the untagged union of the
+three UI level models with untyped taxonomies, each of which was validated
+again when the prompt builder walked them, with the GenerationOptions union
+discriminated by uiLevel, whose taxonomies are typed by the one validation.
+Both walk the taxonomies once, as building a prompt within its token budget
+does. The options are the defaults of each UI level with every taxonomy of
+db-setup/seed_data.json enabled, in a temporary database. Times are CPU time
+per request of one process.
+
+Usage (from the backend directory):
+
+    python -m benchmarks.options_validation [--iterations N]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import timeit
+from pathlib import Path
+from typing import Iterable, Union
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(_tmp.name) / 'benchmark.db'}"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import Field, TypeAdapter  # noqa: E402
+
+from app.db.base import SessionLocal  # noqa: E402
+from app.models._base import ToggledOptionGroupArray  # noqa: E402
+from app.models.generationoptions import (  # noqa: E402
+    AmpleGenerationOptions,
+    GenerationOptions,
+    ModularGenerationOptions,
+    StandardGenerationOptions,
+    ui_level_models,
+)
+from app.models.metadata import create_metadata  # noqa: E402
+from app.models.taxonomies import NoneTaxonomy, Taxonomy  # noqa: E402
+from benchmarks.loadtest import default_value, seed_database  # noqa: E402
+
+
+# the taxonomy arrays as they were before their taxonomies were typed
+class LegacyStandardTaxonomyArray(ToggledOptionGroupArray):
+    class Config:
+        extra = "allow"
+
+    multiple: bool = False
+
+    none: NoneTaxonomy = Field(
+        title="No Taxonomy",
+        description="By toggling this, no background taxonomy is considered.",
+    )
+
+    def iter_taxonomies(self) -> Iterable[tuple[str, Taxonomy]]:
+        return (
+            (name, Taxonomy.model_validate(d)) for name, d in self.model_extra.items()
+        )
+
+
+class LegacyModularTaxonomyArray(LegacyStandardTaxonomyArray):
+    pass
+
+
+class LegacyCombinableTaxonomyArray(LegacyModularTaxonomyArray):
+    none: None = None
+    multiple: bool = True
+
+
+class LegacyStandardGenerationOptions(StandardGenerationOptions):
+    taxonomies: LegacyStandardTaxonomyArray
+
+
+class LegacyModularGenerationOptions(ModularGenerationOptions):
+    taxonomies: LegacyModularTaxonomyArray
+
+
+class LegacyAmpleGenerationOptions(AmpleGenerationOptions):
+    taxonomies: LegacyCombinableTaxonomyArray
+
+
+untagged = TypeAdapter(
+    Union[
+        LegacyAmpleGenerationOptions,
+        LegacyModularGenerationOptions,
+        LegacyStandardGenerationOptions,
+    ]
+)
+discriminated = TypeAdapter(GenerationOptions)
+
+
+def request_options() -> dict[str, dict]:
+    """The default options of each UI level, as a client sends them."""
+    seed_database(os.environ["DATABASE_URL"])
+    options = {}
+    with SessionLocal() as db:
+        for ui_level, model in ui_level_models.items():
+            metadata = jsonable_encoder(create_metadata(model, db))
+            request = {key: default_value(value) for key, value in metadata.items()}
+            for name, taxonomy in request["taxonomies"].items():
+                taxonomy["enabled"] = name != "none"
+            options[ui_level] = request
+    return options
+
+
+def enabled_taxonomies(options) -> list[str]:
+    # the walk of build_prompt
+    return [
+        name for name, params in options.taxonomies.iter_taxonomies() if params.enabled
+    ]
+
+
+def legacy(request: dict):
+    enabled_taxonomies(untagged.validate_python(request))
+
+
+def typed(request: dict):
+    enabled_taxonomies(discriminated.validate_python(request))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    for ui_level, request in request_options().items():
+        tagged = {**request, "uiLevel": ui_level}
+        assert type(discriminated.validate_python(tagged)) is ui_level_models[ui_level]
+        # each legacy model directly extends the model of its UI level
+        legacy_model = type(untagged.validate_python(request))
+        assert legacy_model.__base__ is ui_level_models[ui_level]
+        results = {
+            "untagged": lambda: legacy(request),
+            "uiLevel inferred": lambda: typed(request),
+            "uiLevel sent": lambda: typed(tagged),
+        }
+        print(f"{ui_level}, {len(request['taxonomies']) - 1} taxonomies")
+        baseline = None
+        for name, function in results.items():
+            seconds = min(
+                timeit.repeat(
+                    function, number=args.iterations, repeat=5, timer=time.process_time
+                )
+            )
+            per_request = seconds / args.iterations * 1e6
+            baseline = baseline or per_request
+            print(
+                f"{name:>18}: {per_request:8.1f} µs/request "
+                f"{1e6 / per_request:8.0f} requests/s ({baseline / per_request:.2f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
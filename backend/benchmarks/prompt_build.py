@@ -0,0 +1,260 @@
+"""Micro-benchmark of building prompts from generation options.
+
+Compares build_prompt() against the previous implementation, which concatenated
+the prompt with str += and walked the taxonomies twice per request, using the
+taxonomies from db-setup/seed_data.json. No database or LLM is needed.
+
+Usage (from the backend directory):
+
+    python -m benchmarks.prompt_build [--iterations N]
+"""
+
+import argparse
+import json
+import os
+import timeit
+from pathlib import Path
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from app.db.models import StepType, TaxonomyOrmItem  # noqa: E402
+from app.models.educationinfo import ModularEducationInfo  # noqa: E402
+from app.models.generationoptions import (  # noqa: E402
+    AmpleGenerationOptions,
+    GenerationOptions,
+    ModularGenerationOptions,
+)
+from app.prompt import build_prompt  # noqa: E402
+
+SEED_DATA = Path(__file__).parent.parent / "db-setup" / "seed_data.json"
+
+
+def load_taxonomies() -> dict[str, TaxonomyOrmItem]:
+    with open(SEED_DATA, "r") as f:
+        seed = json.load(f)
+    taxonomies = {}
+    for taxonomy in seed["taxonomies"]:
+        group = [
+            dict(
+                id=int(parameter["id"]),
+                name=parameter["name"],
+                short_description=parameter["short_description"],
+                fixed=parameter["disabled"] == "True",
+            )
+            for parameter in seed["parameters"]
+            if parameter["taxonomy_id"] == str(taxonomy["id"])
+        ]
+        item = TaxonomyOrmItem.model_validate(
+            dict(
+                id=int(taxonomy["id"]),
+                name=taxonomy["name"],
+                short_description=taxonomy["short_description"],
+                text=taxonomy["text"],
+                ui_level=taxonomy["ui_level"],
+                priority=float(taxonomy["priority"]),
+                step_type=taxonomy["step_type"],
+                group=group,
+            )
+        )
+        taxonomies[item.name] = item
+    return taxonomies
+
+
+def ample_options(taxonomies: dict[str, TaxonomyOrmItem]) -> AmpleGenerationOptions:
+    """Options with every taxonomy enabled, i.e. the largest prompt."""
+    return AmpleGenerationOptions.model_validate(
+        {
+            "taxonomies": {
+                name: {
+                    "enabled": True,
+                    "priority": taxonomy.priority,
+                    **{
+                        parameter.name: i % 3 + 1
+                        for i, parameter in enumerate(taxonomy.group or [])
+                    },
+                }
+                for name, taxonomy in taxonomies.items()
+            },
+            "educationInfo": {
+                "educationLevel": "6",
+                "targetType": "Course",
+                "targetName": "Databases",
+                "contextDescription": "Second year computer science students.",
+                "previousLearningGoals": "Know SQL.\nKnow ER diagrams.",
+            },
+            "outputOptions": {
+                "learningGoals": {"enabled": True},
+                "learningOutcomes": {"enabled": False},
+                "competencyProfile": {"enabled": False},
+            },
+            "inspirationSeeds": {"keywords": ["normalisation", "indexes"]},
+            "customInputs": {
+                "customInstruction": "Answer in Danish.",
+                "extraInputs": ["Course description"],
+            },
+            "llmSettings": {},
+        }
+    )
+
+
+# the implementation before prompts were compiled, kept as the baseline
+def legacy_build_prompt(
+    options: GenerationOptions, taxonomies_info: dict[str, TaxonomyOrmItem]
+) -> str:
+    prompt = ""
+
+    # background knowledge
+    if options.taxonomies.is_any_enabled():
+        prompt += "Below are descriptions of educational taxonomies as background information:\n\n"
+        for taxonomy_name, taxonomy_params in options.taxonomies.iter_taxonomies():
+            if not taxonomy_params.enabled:
+                continue
+            prompt += f"Title: {taxonomy_name}\n\n"
+            prompt += f"{taxonomies_info[taxonomy_name].text}"
+            prompt += "\n\n"
+
+    # custom inputs
+    if (
+        isinstance(options, AmpleGenerationOptions)
+        and options.custom_inputs.extra_inputs
+    ):
+        prompt += "Also pay heed to the following information:\n\n"
+        for value in options.custom_inputs.extra_inputs:
+            if value:
+                prompt += f"{value}:\n\n"
+
+    if options.taxonomies.is_any_enabled():
+        prompt += (
+            "Your response should be based on the provided taxonomies where you aim for the following levels of "
+            "competency for the described aspects:"
+        )
+        prompt += "\n"
+        for taxonomy_name, taxonomy_params in options.taxonomies.iter_taxonomies():
+            if not taxonomy_params.enabled:
+                continue
+            prompt += f"- {taxonomy_name}\n"
+            step_type = taxonomies_info[taxonomy_name].step_type
+            for param_name, param_value in taxonomy_params.iter_options():
+                if param_value == 0:
+                    prompt += f"\t- Ignore '{param_name}'.\n"
+                elif step_type == StepType.ATTENTION:
+                    prompt += f"\t- Pay {StepType.ATTENTION.steps()[param_value]} to '{param_name}'.\n"
+                elif step_type == StepType.LEVEL:
+                    prompt += f"\t- Aim for a {StepType.LEVEL.steps()[param_value]} level for '{param_name}'.\n"
+
+        prompt += "\n\n"
+
+    target_type = (options.education_info.target_type or "education").lower()
+    target_name = options.education_info.target_name.strip()
+    if isinstance(options, AmpleGenerationOptions):
+        level = "EQF level " + options.education_info.education_level
+    else:
+        level = options.education_info.education_level + " level"
+
+    if options.education_info.context_description:
+        prompt += "\n\n"
+        prompt += (
+            f"Your response should fit with the {target_type}"
+            f"{' called ' + target_name if target_name else ''} at {level}"
+            " where you take into account the following contextual information: "
+            f"{options.education_info.context_description}"
+        )
+
+        prompt += "\n\n"
+
+    if (
+        isinstance(options.education_info, ModularEducationInfo)
+        and options.education_info.previous_learning_goals
+    ):
+        prompt += "Take into account these previous learning goals:\n"
+        prompt += options.education_info.previous_learning_goals
+        prompt += "\n\n"
+
+    if (
+        isinstance(options, AmpleGenerationOptions)
+        and options.custom_inputs.custom_instruction
+    ):
+        prompt += options.custom_inputs.custom_instruction
+        prompt += "\n\n"
+
+    # output formatting
+    if target_name:
+        prompt += f"For the {target_type} {target_name} at {level}, "
+    else:
+        prompt += f"For any {target_type} at {level}, "
+
+    if options.output_options.learning_goals.enabled:
+        prompt += (
+            "define clear and broad learning goals that outline the general knowledge, "
+            "skills, and competencies students are expected to develop. These should "
+            "be aligned with the overall educational objectives and provide a foundation "
+            "for the specific learning outcomes."
+        )
+    elif options.output_options.learning_outcomes.enabled:
+        prompt += (
+            "specify detailed and measurable learning outcomes that describe the specific "
+            "knowledge, skills, and abilities students should demonstrate. These should be "
+            "precise, observable, and directly linked to the assessment methods used."
+        )
+    elif options.output_options.competency_profile.enabled:
+        if target_type == "education" or target_type == "programme":
+            prompt += (
+                "develop a comprehensive curriculum competency profile that outlines the key "
+                "competencies students are expected "
+                "to acquire by the time they graduate. This profile should encompass a broad "
+                "range of skills, knowledge, and attitudes across all courses, reflecting "
+                "the program’s core objectives and aligning with industry standards and "
+                "professional requirements."
+            )
+        else:
+            prompt += (
+                "create a detailed competency profile that identifies the essential skills, "
+                "knowledge, and attitudes students are expected to develop. This profile should "
+                "align with the broader program competencies while focusing on the unique "
+                f"outcomes of the {target_type}, ensuring students are prepared for both academic "
+                "progression and practical application."
+            )
+
+    prompt += "\n\n"
+
+    if (
+        isinstance(options, ModularGenerationOptions)
+        and options.inspiration_seeds.keywords
+    ):
+        prompt += "Use these keywords as seed for inspiration: " + ", ".join(
+            options.inspiration_seeds.keywords
+        )
+
+    return prompt.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    taxonomies = load_taxonomies()
+    options = ample_options(taxonomies)
+    prompt = build_prompt(options, taxonomies)
+    assert prompt == legacy_build_prompt(options, taxonomies), "prompts differ"
+
+    results = {
+        "legacy": lambda: legacy_build_prompt(options, taxonomies),
+        "build_prompt": lambda: build_prompt(options, taxonomies),
+    }
+    print(
+        f"{len(taxonomies)} taxonomies, {len(prompt)} characters, "
+        f"{args.iterations} iterations"
+    )
+    baseline = None
+    for name, function in results.items():
+        seconds = min(timeit.repeat(function, number=args.iterations, repeat=5))
+        per_request = seconds / args.iterations * 1e6
+        baseline = baseline or per_request
+        print(
+            f"{name:>16}: {per_request:8.1f} µs/prompt ({baseline / per_request:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
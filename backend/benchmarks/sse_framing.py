@@ -0,0 +1,115 @@
+"""Benchmark of framing streamed responses as server-sent events.
+
+Runs many concurrent synthetic token streams through the previous framing, one
+event per chunk, and through the coalescing framing of app.sse, and reports the
+writes and the CPU time per stream. The events are sent through the same
+StreamingResponse as in the application, and like a server, every body message
+is written with a separate write() call, here to /dev/null, so the writes are
+the syscalls per stream.
+
+Usage (from the backend directory):
+
+    python -m benchmarks.sse_framing [--streams N] [--tokens N] [--delay SECONDS]
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from typing import AsyncIterator, Callable
+
+from starlette.responses import StreamingResponse
+
+from app.sse import Coalescer
+
+
+async def tokens(count: int, delay: float) -> AsyncIterator[str]:
+    for i in range(count):
+        await asyncio.sleep(delay)
+        yield f"word{i}" + ("\n" if i % 10 == 9 else " ")
+
+
+# consumes the stream without sending anything, the cost of the source alone
+async def no_events(stream: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    async for _ in stream:
+        pass
+    yield b""
+
+
+# the framing before chunks were coalesced, kept as the baseline
+async def per_chunk_events(stream: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    event_id = 0
+    async for t in stream:
+        event_id += 1
+        data = t.replace("\n", "\\n")
+        yield f"id: {event_id}\ndata: {data}\n\n".encode("utf-8")
+
+
+async def run(
+    frame: Callable[[AsyncIterator[str]], AsyncIterator[bytes]],
+    streams: int,
+    count: int,
+    delay: float,
+) -> tuple[float, float, float, float]:
+    writes = 0
+    written = 0
+
+    async def consume():
+        fd = os.open(os.devnull, os.O_WRONLY)
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal writes, written
+            body = message.get("body")
+            if body:
+                os.write(fd, body)
+                writes += 1
+                written += len(body)
+
+        response = StreamingResponse(
+            frame(tokens(count, delay)), media_type="text/event-stream"
+        )
+        try:
+            await response({"type": "http"}, receive, send)
+        finally:
+            os.close(fd)
+
+    start_cpu, start = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(consume() for _ in range(streams)))
+    cpu, elapsed = time.process_time() - start_cpu, time.perf_counter() - start
+    return writes / streams, written / streams, cpu / streams * 1000, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--delay", type=float, default=0.002)
+    args = parser.parse_args()
+
+    variants = {
+        "source only": no_events,
+        "per chunk": per_chunk_events,
+        "coalesced 50 ms": Coalescer(max_bytes=1024, max_delay=0.05).events,
+        "coalesced 200 ms": Coalescer(max_bytes=4096, max_delay=0.2).events,
+    }
+    print(
+        f"{args.streams} streams of {args.tokens} chunks, "
+        f"one every {args.delay * 1000:g} ms"
+    )
+    for name, frame in variants.items():
+        writes, written, cpu_ms, elapsed = asyncio.run(
+            run(frame, args.streams, args.tokens, args.delay)
+        )
+        print(
+            f"{name:>16}: {writes:7.1f} writes/stream, {written:8.0f} bytes/stream, "
+            f"{cpu_ms:6.2f} ms CPU/stream, {elapsed:5.2f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -45,9 +45,9 @@ def seed_database():
     with open(seed_data_file, "r") as f:
         data = json.load(f)
 
-    overwrite_tables(data, session)
+    rows = overwrite_tables(data, session)
 
-    print("Database seeding complete")
+    print(f"Database seeding complete, {rows} rows")
 
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 import React, { useState } from 'react';
-import { GenerationOptions } from './models';
+import { GenerationOptions, UiLevel } from './models';
 import { Notification } from '../common/Notification';
 import { GenerationService } from '../service/GenerationService';
 import { CopyableMarkdown } from '../common/CopyableMarkdown';
@@ -7,11 +7,13 @@ import Markdown from 'react-markdown';
 
 export interface GenerationPaneProps {
   generationOptions: GenerationOptions;
+  uiLevel: UiLevel;
   service: GenerationService;
 }
 
 export const GenerationPane: React.FC<GenerationPaneProps> = ({
   generationOptions,
+  uiLevel,
   service,
 }: GenerationPaneProps) => {
   const [activeResponse, setActiveResponse] = useState<string | undefined>(
@@ -25,11 +27,11 @@ export const GenerationPane: React.FC<GenerationPaneProps> = ({
 
     service.generateAsStream(
       generationOptions,
+      uiLevel,
       (event) => {
         setActiveResponse(
           (prevState) =>
-            prevState +
-            event.data.toString().replaceAll('\\n', '\n').replaceAll('•', '-'),
+            prevState + event.data.toString().replaceAll('•', '-'),
         );
       },
       () => {
@@ -46,7 +48,7 @@ export const GenerationPane: React.FC<GenerationPaneProps> = ({
   };
 
   const createPrompt = (): void => {
-    service.createPrompt(generationOptions).then((prompt) => {
+    service.createPrompt(generationOptions, uiLevel).then((prompt) => {
       setResponses((prevResponses) => prevResponses.concat(prompt));
       setAtResponse(responses.length);
     });
@@ -113,7 +113,11 @@ export const GeneratorPage: React.FC<GeneratorPageProps> = ({
             />
           ))}
         </div>
-        <GenerationPane generationOptions={options} service={service} />
+        <GenerationPane
+          generationOptions={options}
+          uiLevel={uiLevel}
+          service={service}
+        />
         <div className={'content-pane flex-container__box--equal-size padded'}>
           {rightPanelMetadata.map((metadataEntry) => (
             <OptionsPanel
@@ -11,17 +11,23 @@ export interface GenerationService {
     uiLevel: UiLevel,
   ): Promise<GenerationOptionsMetadata>;
 
-  createPrompt(options: GenerationOptions): Promise<string>;
+  createPrompt(options: GenerationOptions, uiLevel: UiLevel): Promise<string>;
 
-  generate(options: GenerationOptions): Promise<string>;
+  generate(options: GenerationOptions, uiLevel: UiLevel): Promise<string>;
 
   generateAsStream(
     options: GenerationOptions,
+    uiLevel: UiLevel,
     onMessage: (event: MessageEvent<string>) => void,
     onClose?: () => void,
   ): void;
 }
 
+// the generation options as sent to the backend, which validates them against
+// the model of their UI level only
+const requestBody = (options: GenerationOptions, uiLevel: UiLevel): string =>
+  JSON.stringify({ ...options, uiLevel });
+
 export class MockGenerationService implements GenerationService {
   getGenerationOptionsMetadata(): Promise<GenerationOptionsMetadata> {
     const generationOptions: GenerationOptionsMetadata = {
@@ -133,28 +139,38 @@ export class MockGenerationService implements GenerationService {
     return Promise.resolve(generationOptions);
   }
 
-  createPrompt(options: GenerationOptions): Promise<string> {
+  createPrompt(options: GenerationOptions, uiLevel: UiLevel): Promise<string> {
     return Promise.resolve(
       'This prompt is from a mock generation service. Options:\n\n' +
-        JSON.stringify(options, null, 2).replaceAll('\n', '\n\n\t'),
+        JSON.stringify({ ...options, uiLevel }, null, 2).replaceAll(
+          '\n',
+          '\n\n\t',
+        ),
     );
   }
 
-  generate(options: GenerationOptions): Promise<string> {
+  generate(options: GenerationOptions, uiLevel: UiLevel): Promise<string> {
     return Promise.resolve(
       'This response is from a mock generation service. Options:\n\n\t' +
-        JSON.stringify(options, null, 2).replaceAll('\n', '\n\n\t'),
+        JSON.stringify({ ...options, uiLevel }, null, 2).replaceAll(
+          '\n',
+          '\n\n\t',
+        ),
     );
   }
 
   generateAsStream(
     options: GenerationOptions,
+    uiLevel: UiLevel,
     onMessage: (event: MessageEvent<string>) => void,
     onClose?: () => void,
   ): void {
     const responseChunks = (
       'This response is from a mock generation service. Options:\n\n\t' +
-      JSON.stringify(options, null, 2).replaceAll('\n', '\n\n\t')
+      JSON.stringify({ ...options, uiLevel }, null, 2).replaceAll(
+        '\n',
+        '\n\n\t',
+      )
     ).split(' ');
     let index = 0;
     let timeoutId: number;
@@ -190,25 +206,31 @@ export class DefaultGenerationService
     return await response.json();
   }
 
-  async createPrompt(options: GenerationOptions): Promise<string> {
+  async createPrompt(
+    options: GenerationOptions,
+    uiLevel: UiLevel,
+  ): Promise<string> {
     const response = await fetch(this.url + 'generate/create_prompt', {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify(options),
+      body: requestBody(options, uiLevel),
     });
 
     return response.json();
   }
 
-  async generate(options: GenerationOptions): Promise<string> {
+  async generate(
+    options: GenerationOptions,
+    uiLevel: UiLevel,
+  ): Promise<string> {
     const response = await fetch(this.url + 'generate/generate_response', {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify(options),
+      body: requestBody(options, uiLevel),
     });
 
     const json = await response.json();
@@ -217,13 +239,14 @@ export class DefaultGenerationService
 
   generateAsStream(
     options: GenerationOptions,
+    uiLevel: UiLevel,
     onMessage: (event: MessageEvent<string>) => void,
     onClose?: () => void,
   ): void {
     fetch(this.url + 'generate/start_stream', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify(options),
+      body: requestBody(options, uiLevel),
     }).then((response) => {
       if (response.ok) {
         response.json().then((json) => {